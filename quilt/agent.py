@@ -0,0 +1,454 @@
+"""
+Remote-side helpers for quilt resources.
+
+This module is shipped verbatim to the remote interpreter by
+quilt.pushy_support.remote_agent, so it may only depend on the standard
+library. Functions are called through `dispatch`, which takes and returns
+marshalled data so that each call costs exactly one round-trip.
+"""
+import os
+import stat
+import errno
+import marshal
+import hashlib
+
+def dispatch(name, payload):
+    args = marshal.loads(payload)
+    return marshal.dumps(globals()[name](*args))
+
+def file_hash(path, blocksize=65536):
+    digest = hashlib.sha256()
+    f = open(path, 'rb')
+    try:
+        block = f.read(blocksize)
+        while block:
+            digest.update(block)
+            block = f.read(blocksize)
+    finally:
+        f.close()
+    return digest.hexdigest()
+
+def read_file(path):
+    f = open(path, 'rb')
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+def path_facts(path):
+    """
+    Returns a compact record describing `path`.
+    """
+    facts = {
+        'exists': os.path.exists(path),
+        'type': None,
+        'uid': None,
+        'gid': None,
+        'mode': None,
+        'readable': os.access(path, os.R_OK),
+        'writable': os.access(path, os.W_OK),
+        'sha256': None,
+        'size': None,
+        'empty': None,
+    }
+    if os.path.islink(path):
+        facts['type'] = 'symlink'
+    elif os.path.isdir(path):
+        facts['type'] = 'directory'
+    elif os.path.isfile(path):
+        facts['type'] = 'file'
+    elif facts['exists']:
+        facts['type'] = 'other'
+
+    if not facts['exists']:
+        return facts
+
+    st = os.stat(path)
+    facts['uid'] = st.st_uid
+    facts['gid'] = st.st_gid
+    facts['mode'] = stat.S_IMODE(st.st_mode)
+
+    if facts['type'] == 'file':
+        facts['size'] = st.st_size
+    if facts['type'] in ('file', 'symlink') and facts['readable'] \
+            and os.path.isfile(path):
+        # links are hashed through, eg. a virtualenv's interpreter
+        facts['sha256'] = file_hash(path)
+    elif facts['type'] == 'directory' and facts['readable']:
+        facts['empty'] = not os.listdir(path)
+    return facts
+
+def identities():
+    """
+    Returns the full user and group tables as name -> id maps.
+    """
+    import pwd
+    import grp
+    return {
+        'users': dict((p[0], p[2]) for p in pwd.getpwall()),
+        'groups': dict((g[0], g[2]) for g in grp.getgrall()),
+    }
+
+def lookup_ids(users=(), groups=()):
+    """
+    Looks up individual user and group names, for NSS backends that do not
+    enumerate all of their entries. Missing names map to None.
+    """
+    import pwd
+    import grp
+    result = {'users': {}, 'groups': {}}
+    for user in users:
+        try:
+            result['users'][user] = pwd.getpwnam(user)[2]
+        except KeyError:
+            result['users'][user] = None
+    for group in groups:
+        try:
+            result['groups'][group] = grp.getgrnam(group)[2]
+        except KeyError:
+            result['groups'][group] = None
+    return result
+
+def gather_facts(paths, with_identities=False):
+    """
+    Returns facts for each of `paths`, the uid we run as, and optionally the
+    user and group tables.
+    """
+    result = {'paths': {}, 'uid': os.getuid()}
+    for path in paths:
+        result['paths'][path] = path_facts(path)
+    if with_identities:
+        result['identities'] = identities()
+    return result
+
+def signature(path):
+    """
+    Returns a cheap stat-based signature of `path`, which changes when its
+    type, mode or ownership does, or (for files) its content is rewritten.
+    None if it does not exist.
+    """
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return None
+    if stat.S_ISLNK(st.st_mode):
+        # ownership and mode are checked through the link
+        try:
+            target = os.stat(path)
+        except OSError:
+            return ['symlink', os.readlink(path)]
+        return ['symlink', os.readlink(path), stat.S_IMODE(target.st_mode),
+                target.st_uid, target.st_gid]
+    sig = [stat.S_IFMT(st.st_mode), stat.S_IMODE(st.st_mode), st.st_uid,
+            st.st_gid]
+    if stat.S_ISREG(st.st_mode):
+        sig.extend([st.st_size, st.st_mtime, st.st_ino])
+    return sig
+
+def load_manifest(manifest):
+    import json
+    try:
+        f = open(os.path.expanduser(manifest), 'rb')
+    except IOError:
+        return {}
+    try:
+        try:
+            return json.load(f)
+        except ValueError:
+            return {}
+    finally:
+        f.close()
+
+def check_manifest(manifest, entries):
+    """
+    Returns the keys of `entries` (key -> [path, desired state hash]) that the
+    manifest records with the same desired state and the path's current
+    signature.
+    """
+    recorded = load_manifest(manifest)
+    unchanged = []
+    for key, (path, desired) in entries.items():
+        entry = recorded.get(key)
+        if (entry and entry['path'] == path and entry['desired'] == desired
+                and entry['signature'] == signature(path)):
+            unchanged.append(key)
+    return unchanged
+
+def update_manifest(manifest, entries, full=False):
+    """
+    Records each of `entries` in the manifest along with its path's current
+    signature. Returns the whole manifest if `full` is set, else True; None if
+    it could not be written.
+    """
+    import json
+    recorded = load_manifest(manifest)
+    for key, (path, desired) in entries.items():
+        recorded[key] = {'path': path, 'desired': desired,
+            'signature': signature(path)}
+    path = os.path.expanduser(manifest)
+    try:
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, 0700)
+        op_write(path, json.dumps(recorded), 0600)
+    except (OSError, IOError):
+        return None
+    return full and recorded or True
+
+def shell(command, combine_stderr=True):
+    """
+    Runs a shell command, returning its output, error output and exit status.
+    """
+    import subprocess
+    devnull = open(os.devnull, 'rb')
+    try:
+        stderr = combine_stderr and subprocess.STDOUT or subprocess.PIPE
+        proc = subprocess.Popen(command, shell=True, stdin=devnull,
+                stdout=subprocess.PIPE, stderr=stderr)
+        stdout, stderr = proc.communicate()
+    finally:
+        devnull.close()
+    return (stdout, stderr or '', proc.returncode)
+
+def compare_tree(root, entries, uid=-1, gid=-1, delete=False):
+    """
+    Compares the tree below `root` with `entries`, a manifest of relative
+    paths:
+
+        {'a/b': ['file', mode, size, mtime, sha256],
+         'a': ['directory', mode],
+         'a/c': ['symlink', target]}
+
+    and returns [relative path, reason] pairs for those that differ, reason
+    being one of missing, type, content, mtime, mode or owner. Files are only
+    hashed when their size matches but their mtime does not. With `delete`,
+    paths not in `entries` are listed first (deepest first) as extra or
+    extra_dir.
+    """
+    changes = []
+    if delete and os.path.isdir(root):
+        for directory, dirs, files in os.walk(root, topdown=False):
+            relative = os.path.relpath(directory, root)
+            for name in files + dirs:
+                rel = os.path.normpath(os.path.join(relative, name))
+                if rel in entries:
+                    continue
+                path = os.path.join(directory, name)
+                if os.path.isdir(path) and not os.path.islink(path):
+                    changes.append([rel, 'extra_dir'])
+                else:
+                    changes.append([rel, 'extra'])
+
+    for rel in sorted(entries):
+        entry = entries[rel]
+        path = os.path.join(root, rel)
+        try:
+            st = os.lstat(path)
+        except OSError:
+            changes.append([rel, 'missing'])
+            continue
+        kind = entry[0]
+        if kind == 'symlink':
+            if not stat.S_ISLNK(st.st_mode):
+                changes.append([rel, 'type'])
+            elif os.readlink(path) != entry[1]:
+                changes.append([rel, 'content'])
+            continue
+        if ((kind == 'directory' and not stat.S_ISDIR(st.st_mode)) or
+                (kind == 'file' and not stat.S_ISREG(st.st_mode))):
+            changes.append([rel, 'type'])
+            continue
+        if kind == 'file':
+            size, mtime, sha256 = entry[2:5]
+            if st.st_size != size:
+                changes.append([rel, 'content'])
+                continue
+            if int(st.st_mtime) != mtime:
+                if file_hash(path) != sha256:
+                    changes.append([rel, 'content'])
+                    continue
+                changes.append([rel, 'mtime'])
+        if stat.S_IMODE(st.st_mode) != entry[1]:
+            changes.append([rel, 'mode'])
+        if (uid != -1 and uid != st.st_uid) or (gid != -1 and gid != st.st_gid):
+            changes.append([rel, 'owner'])
+    return changes
+
+def git_head(path):
+    """
+    Returns the commit checked out in the git work tree at `path`, read from
+    its files rather than by running git, or None if there is none.
+    """
+    git = os.path.join(path, '.git')
+    try:
+        head = read_file(os.path.join(git, 'HEAD')).strip()
+    except IOError:
+        return None
+    if not head.startswith('ref: '):
+        return head
+    ref = head[len('ref: '):]
+    try:
+        return read_file(os.path.join(git, ref)).strip()
+    except IOError:
+        pass
+    try:
+        packed = read_file(os.path.join(git, 'packed-refs'))
+    except IOError:
+        return None
+    for line in packed.splitlines():
+        if line.endswith(' ' + ref):
+            return line.split()[0]
+    return None
+
+def stage(data, staged=None):
+    """
+    Appends `data` to a temporary file, created if `staged` is None, and
+    returns its path. Large uploads arrive this way a chunk at a time, and are
+    then moved into place by op_write.
+    """
+    if staged is None:
+        import tempfile
+        fd, staged = tempfile.mkstemp(prefix='quilt-')
+        os.close(fd)
+    f = open(staged, 'ab')
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    return staged
+
+def op_mkdir(path, mode):
+    os.mkdir(path, mode)
+    # mkdir's mode is subject to the umask
+    os.chmod(path, mode)
+
+def op_write(path, content=None, mode=0644, uid=-1, gid=-1, mtime=None,
+        staged=None):
+    """
+    Replaces the contents of `path` atomically, by renaming a temporary file
+    with the final mode, ownership and (if given) mtime over it. Falls back to
+    writing in place when the parent directory is not writable. The content
+    may come from a `staged` file instead, which is removed once written.
+    """
+    import tempfile
+    directory, name = os.path.split(path)
+    try:
+        fd, tmp = tempfile.mkstemp(prefix='.{}.'.format(name), dir=directory)
+    except OSError:
+        if not os.path.exists(path) or not os.access(path, os.W_OK):
+            raise
+        f = open(path, 'wb')
+        try:
+            write_content(f, content, staged)
+        finally:
+            f.close()
+        op_chmod(path, mode)
+        op_chown(path, uid, gid)
+        if mtime is not None:
+            op_utime(path, mtime)
+    else:
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                write_content(f, content, staged)
+            finally:
+                f.close()
+            os.chmod(tmp, mode)
+            st = os.stat(tmp)
+            if (uid != -1 and uid != st.st_uid) or (gid != -1 and gid != st.st_gid):
+                os.chown(tmp, uid, gid)
+            if mtime is not None:
+                os.utime(tmp, (mtime, mtime))
+            os.rename(tmp, path)
+        except:
+            os.unlink(tmp)
+            raise
+    if staged is not None:
+        os.unlink(staged)
+
+def write_content(f, content, staged=None):
+    if staged is None:
+        f.write(content)
+        return
+    import shutil
+    source = open(staged, 'rb')
+    try:
+        shutil.copyfileobj(source, f)
+    finally:
+        source.close()
+
+def op_symlink(path, target):
+    os.symlink(target, path)
+
+def op_chmod(path, mode):
+    if stat.S_IMODE(os.stat(path).st_mode) != mode:
+        os.chmod(path, mode)
+
+def op_utime(path, mtime):
+    os.utime(path, (mtime, mtime))
+
+def op_chown(path, uid=-1, gid=-1, recursive=False):
+    paths = [path]
+    if recursive and os.path.isdir(path) and not os.path.islink(path):
+        for root, dirs, files in os.walk(path):
+            paths.extend([os.path.join(root, n) for n in dirs + files])
+    for p in paths:
+        # links below `path` are changed themselves rather than followed
+        if p != path and os.path.islink(p):
+            st, chown = os.lstat(p), os.lchown
+        else:
+            st, chown = os.stat(p), os.chown
+        if (uid != -1 and uid != st.st_uid) or (gid != -1 and gid != st.st_gid):
+            chown(p, uid, gid)
+
+def op_remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        os.rmdir(path)
+    else:
+        os.unlink(path)
+
+def apply(operations, archive=None, staged_archive=None):
+    """
+    Runs a list of filesystem operations in order. Each operation is a dict
+    with an 'op' name (mkdir, write, symlink, chmod, utime, chown or remove)
+    and the arguments for it. Returns a result dict per operation attempted;
+    the first failed operation stops the batch, as later ones may depend on
+    it.
+
+    Write operations may name a `member` of `archive`, a gzipped tar, in
+    place of their content, or of a tar left at `staged_archive` by an
+    earlier call. When an operation is not permitted, the archive is left
+    staged this way, and its result names the path, so that the rest can be
+    applied in another session without sending the content again.
+    """
+    tar = None
+    if archive or staged_archive:
+        import gzip
+        import tarfile
+        from StringIO import StringIO
+        if archive:
+            # decompressed up front, as seeking back in a gzip stream starts
+            # decompressing again from the beginning
+            archive = gzip.GzipFile(fileobj=StringIO(archive)).read()
+        else:
+            archive = read_file(staged_archive)
+            os.unlink(staged_archive)
+        tar = tarfile.open(fileobj=StringIO(archive))
+        # looking members up by name scans the whole archive
+        members = dict((m.name, m) for m in tar.getmembers())
+    results = []
+    for operation in operations:
+        args = dict(operation)
+        func = globals()['op_' + args.pop('op')]
+        if 'member' in args:
+            args['content'] = tar.extractfile(members[args.pop('member')]).read()
+        try:
+            func(**args)
+        except (OSError, IOError), e:
+            result = {'ok': False, 'errno': e.errno, 'error': str(e)}
+            if tar is not None and e.errno in (errno.EPERM, errno.EACCES):
+                result['archive'] = stage(archive)
+            results.append(result)
+            break
+        results.append({'ok': True, 'errno': None, 'error': None})
+    return results
@@ -0,0 +1,301 @@
+"""
+Converge benchmarks, run against the local machine.
+
+Each benchmark converges a synthetic workload under a scratch directory,
+first from scratch (cold) and then again with nothing left to change
+(no-op). Every run happens in a fresh process, as a real converge would, and
+talks to the "remote" side through a local pushy connection with Fabric's
+run, sudo and put shimmed to act locally, so no SSH host is needed:
+
+    python -m quilt.benchmark files:1000 tree:1000 programs:100
+
+Reports round-trips, bytes, wall time, the number of changes and peak memory
+(local and remote, in KB) for each run.
+"""
+import argparse
+import contextlib
+import grp
+import json
+import os
+import pwd
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from fabric import operations
+from fabric.api import env, abort
+
+DEFAULT_WORKLOADS = ['files:1000', 'files:10000', 'tree:1000', 'programs:100']
+
+@contextlib.contextmanager
+def loopback():
+    """
+    Context manager within which quilt converges the local machine as if it
+    were `localhost`. Enter it before enabling quilt.instrument, so that the
+    local commands are counted.
+    """
+    from quilt import pushy_support
+    saved = dict((k, env.get(k)) for k in ('host_string', 'user', 'pushy_transport',
+            'pushy_sudo'))
+    run_command = operations._run_command
+    put = operations.put
+    modules = [m for m in sys.modules.values()
+            if m is not None and m.__name__.startswith('quilt')
+            and getattr(m, 'put', None) is put]
+
+    env.host_string = 'localhost'
+    env.user = pwd.getpwuid(os.getuid())[0]
+    env.pushy_transport = 'local:'
+    # the local transport always runs sys.executable, so it cannot sudo
+    env.pushy_sudo = None
+    operations._run_command = local_run_command
+    for module in modules:
+        module.put = local_put
+    try:
+        yield
+    finally:
+        operations._run_command = run_command
+        for module in modules:
+            module.put = put
+        for conn in pushy_support.connections.values():
+            conn.close()
+        pushy_support.reset()
+        env.update(saved)
+
+def local_run_command(command, shell=True, pty=True, combine_stderr=True,
+        sudo=False, user=None, quiet=False, warn_only=False, **kwargs):
+    """
+    Stands in for Fabric's _run_command, behind both run and sudo. Commands
+    run as the current user.
+    """
+    if env.cwd:
+        command = 'cd {} && {}'.format(env.cwd, command)
+    proc = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+    stdout, stderr = proc.communicate()
+    result = operations._AttributeString(stdout.rstrip('\n'))
+    result.stderr = stderr.rstrip('\n')
+    result.command = result.real_command = command
+    result.return_code = proc.returncode
+    result.succeeded = proc.returncode == 0
+    result.failed = not result.succeeded
+    if result.failed and not (warn_only or env.warn_only):
+        abort('Local command failed: {}\n{}'.format(command, result.stderr))
+    return result
+
+def local_put(local_path=None, remote_path=None, use_sudo=False, mode=None,
+        **kwargs):
+    """
+    Stands in for Fabric's put, for file-like objects or local paths.
+    """
+    if isinstance(local_path, basestring):
+        shutil.copyfile(local_path, remote_path)
+    else:
+        with open(remote_path, 'wb') as f:
+            f.write(local_path.read())
+    if mode is not None:
+        os.chmod(remote_path, mode)
+    return [remote_path]
+
+def owner_settings():
+    """
+    Returns owner and group settings for the current user, so that
+    benchmarks do not need to run as root.
+    """
+    return {
+        'owner': pwd.getpwuid(os.getuid())[0],
+        'group': grp.getgrgid(os.getgid())[0],
+    }
+
+def files_workload(root, size):
+    """
+    `size` files, a hundred to a directory.
+    """
+    from quilt.contrib import fs
+    from quilt.resources import ResourceCollection
+    owner = owner_settings()
+    items = [fs.Directory(root + '/', **owner)]
+    for i in range(size):
+        directory = os.path.join(root, 'd{}'.format(i / 100))
+        if not i % 100:
+            items.append(fs.Directory(directory + '/', **owner))
+        items.append(fs.File(os.path.join(directory, 'f{}'.format(i)),
+                content='file {}\n'.format(i), **owner))
+    return ResourceCollection(*items)
+
+def tree_workload(root, size, fanout=2):
+    """
+    A tree of `size` directories, `fanout` to a directory.
+    """
+    from quilt.contrib import fs
+    from quilt.resources import ResourceCollection
+    owner = owner_settings()
+    items = [fs.Directory(root + '/', **owner)]
+    paths = [root]
+    for i in range(1, size):
+        path = os.path.join(paths[(i - 1) / fanout], str(i))
+        paths.append(path)
+        items.append(fs.Directory(path + '/', **owner))
+    return ResourceCollection(*items)
+
+def programs_workload(root, size):
+    """
+    `size` supervisor programs, each with a log directory.
+    """
+    from quilt.contrib import fs, supervisor
+    from quilt.resources import ResourceCollection
+    owner = owner_settings()
+    # stands in for supervisorctl, which runs once if any program changed
+    env.resources.supervisor.update_command = 'true'
+    items = [
+        fs.Directory(root + '/', **owner),
+        fs.Directory(os.path.join(root, 'conf.d') + '/', **owner),
+        fs.Directory(os.path.join(root, 'log') + '/', **owner),
+    ]
+    for i in range(size):
+        name = 'program{}'.format(i)
+        items.append(supervisor.Program(name, command='/bin/true',
+                conf_dir=os.path.join(root, 'conf.d'),
+                log_dir=os.path.join(root, 'log', name), **owner))
+    return ResourceCollection(*items)
+
+WORKLOADS = {
+    'files': files_workload,
+    'tree': tree_workload,
+    'programs': programs_workload,
+}
+
+def run_once(workload, size, root, workers=None, manifest=False):
+    """
+    Converges a workload in this process and returns its measurements. With
+    `manifest`, the fs manifest is kept next to `root`.
+    """
+    from quilt import instrument, pushy_support
+    from quilt.contrib import fs
+    if manifest:
+        env.resources.fs.manifest = os.path.join(os.path.dirname(root),
+                'manifest.json')
+    with loopback():
+        instrument.reset()
+        instrument.enable()
+        collection = WORKLOADS[workload](root, size)
+        start = time.time()
+        collection.ensure(workers)
+        elapsed = time.time() - start
+        instrument.disable()
+
+        totals = instrument.summary()['hosts'].get(env.host_string, {})
+        changes = [e for e in instrument.export()['events']
+                if e['category'] == 'log']
+        remote = pushy_support.get_connection().modules.resource
+        return {
+            'elapsed': elapsed,
+            'round_trips': totals.get('round_trips', 0),
+            'bytes_sent': totals.get('bytes_sent', 0),
+            'bytes_received': totals.get('bytes_received', 0),
+            'changes': len(changes),
+            'maxrss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'remote_maxrss': remote.getrusage(remote.RUSAGE_SELF).ru_maxrss,
+        }
+
+def run_process(workload, size, root, workers=None, manifest=False,
+        verbose=False):
+    """
+    Converges a workload in a fresh process and returns its measurements.
+    """
+    fd, output = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    child_env = dict(os.environ)
+    child_env['PYTHONPATH'] = os.pathsep.join(
+            [package_dir] + filter(None, [child_env.get('PYTHONPATH')]))
+    command = [sys.executable, '-m', 'quilt.benchmark', '--child', output,
+            '--workers', str(workers or 1), '--root', root,
+            '{}:{}'.format(workload, size)]
+    if manifest:
+        command.append('--manifest')
+    try:
+        with open(os.devnull, 'w') as devnull:
+            returncode = subprocess.call(command, env=child_env,
+                    stdout=None if verbose else devnull)
+        if returncode != 0:
+            abort('Benchmark {}:{} failed'.format(workload, size))
+        with open(output) as f:
+            return json.load(f)
+    finally:
+        os.unlink(output)
+
+def benchmark(specs, workers=None, manifest=False, verbose=False):
+    """
+    Runs each workload spec ("name:size") cold, then as a no-op, and returns
+    the measurements for each run.
+    """
+    results = []
+    for spec in specs:
+        workload, size = parse_spec(spec)
+        root = tempfile.mkdtemp(prefix='quilt-benchmark-')
+        try:
+            for phase in ('cold', 'noop'):
+                result = run_process(workload, size, os.path.join(root, 'w'),
+                        workers, manifest, verbose)
+                result.update(workload=workload, size=size, phase=phase)
+                results.append(result)
+        finally:
+            shutil.rmtree(root)
+    return results
+
+def parse_spec(spec):
+    workload, _, size = spec.partition(':')
+    if workload not in WORKLOADS or not size.isdigit():
+        abort('Unknown workload {} (expected one of {}, followed by :size)'.format(
+                spec, ', '.join(sorted(WORKLOADS))))
+    return workload, int(size)
+
+def report(results):
+    columns = ['workload', 'size', 'phase', 'elapsed', 'round_trips',
+            'bytes_sent', 'bytes_received', 'changes', 'maxrss', 'remote_maxrss']
+    print '  '.join('{:>14}'.format(c) for c in columns)
+    for result in results:
+        values = []
+        for column in columns:
+            value = result[column]
+            if isinstance(value, float):
+                value = '{:.3f}'.format(value)
+            values.append('{:>14}'.format(value))
+        print '  '.join(values)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark quilt converges.')
+    parser.add_argument('workloads', nargs='*', default=DEFAULT_WORKLOADS,
+            help='workloads to run, as name:size (default: {})'.format(
+                ' '.join(DEFAULT_WORKLOADS)))
+    parser.add_argument('--workers', type=int, default=1,
+            help='resources ensured concurrently')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--manifest', action='store_true',
+            help='converge incrementally, with the fs manifest')
+    parser.add_argument('--verbose', action='store_true',
+            help="show the resources' output")
+    parser.add_argument('--root', help=argparse.SUPPRESS)
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        workload, size = parse_spec(args.workloads[0])
+        result = run_once(workload, size, args.root, args.workers,
+                args.manifest)
+        with open(args.child, 'w') as f:
+            json.dump(result, f)
+        return
+
+    results = benchmark(args.workloads, args.workers, args.manifest,
+            args.verbose)
+    report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -1,37 +1,626 @@
 import os
 import stat
+import errno
+import hashlib
+import json
 import sys
+import tempfile
+import threading
 from contextlib import contextmanager
 from StringIO import StringIO
-from fabric.api import sudo, run, env, put, hide
-from quilt.resources import Resource
+from fabric.api import sudo, run, env, put, hide, warn
+from quilt.resources import Resource, simulating, after_planning, before_run
 
 env.resources.fs.file.owner = 'root'
 env.resources.fs.file.group = 'root'
 env.resources.fs.file.mode = 0644
 env.resources.fs.file.newlines = '\n'
+# Size in bytes above which changes to a file are not diffed (always diffed
+# when None)
+env.resources.fs.file.diff_limit = 1024 * 1024
 env.resources.fs.directory.mode = 0755
 env.resources.fs.directory.no_update = False
+env.resources.fs.directory.delete = False
+
+# Directory for jinja2's on-disk bytecode cache (disabled when None)
+env.template_cache_dir = None
+# Manifest of converged paths kept on each host, eg. '~/.quilt/manifest.json'
+# (incremental convergence is disabled when None), and a local directory to
+# keep a copy of each host's manifest in
+env.resources.fs.manifest = None
+env.resources.fs.manifest_mirror = None
+
+# Remote facts cache for the current run, keyed by (host_string, path)
+_facts = {}
+# Remote user and group tables for the current run, keyed by host_string
+_identities = {}
+# Number of runs started, keyed by host_string
+_runs = {}
+# The uid of the remote user, keyed by host_string
+_remote_uids = {}
+# Jinja2 environments, keyed by template directory
+_template_envs = {}
+# Queued filesystem operations, as (resource, op, whether the facts say it
+# needs root), and batch nesting, keyed by host_string
+_pending = {}
+_batch_depth = {}
+_ops_lock = threading.RLock()
+# Keys of resources found unchanged in the manifest, and manifest entries to
+# record once the run succeeds, keyed by host_string
+_unchanged = {}
+_manifest_entries = {}
+# Resource keys and paths converged so far in the current run (the outermost
+# batch, or planning), keyed by host_string, each mapped to the thread
+# converging it and an event set once that has queued its changes
+_converged = {}
+# Digests of local source files, keyed by path, with the size and mtime they
+# were taken at
+_source_hashes = {}
+# Streamed or generated content spooled to local temporary files, kept
+# until exit
+_spool_files = []
+# Content of queued writes to send in each archive, so that neither side
+# holds more than this of a large batch in memory
+ARCHIVE_CHUNK = 32 * 1024 * 1024
+# Content larger than this is spooled to disk locally and uploaded a chunk
+# at a time rather than in the batch's archive
+STREAM_CHUNK = 1024 * 1024
+STREAM_THRESHOLD = 8 * STREAM_CHUNK
+
+def gather_facts(paths, identities=False):
+    """
+    Fetches facts for the given paths from the current host in a single
+    remote call, along with its user and group tables if `identities` is set
+    and they haven't been fetched yet.
+    """
+    from quilt.pushy_support import remote_agent
+    host = env.host_string
+    paths = [p for p in set(paths) if (host, p) not in _facts]
+    identities = identities and host not in _identities
+    if not (paths or identities):
+        return
+    if paths:
+        # facts must reflect any changes we have queued
+        flush()
+    result = remote_agent().gather_facts(paths, identities)
+    _remote_uids[host] = result['uid']
+    for path, facts in result['paths'].iteritems():
+        _facts[(host, path)] = facts
+    if identities:
+        _identities[host] = result['identities']
+
+@contextmanager
+def batch():
+    """
+    Context manager which queues filesystem operations made by resources on
+    the current host, and applies them all in one call on exit (or whenever
+    facts are gathered in the meantime).
+    """
+    host = env.host_string
+    with _ops_lock:
+        _batch_depth[host] = _batch_depth.get(host, 0) + 1
+    try:
+        yield
+    finally:
+        with _ops_lock:
+            _batch_depth[host] -= 1
+            outermost = not _batch_depth[host]
+            if outermost:
+                _converged.pop(host, None)
+                flush()
+    # only reached if every resource was ensured
+    if outermost:
+        record_manifest()
+
+def flush():
+    """
+    Applies the filesystem operations queued for the current host. Those the
+    facts show the remote session isn't permitted to perform are sent to
+    `privileged_apply` together. If it turns out not to be permitted to
+    perform another, that one and the rest of its batch follow.
+    """
+    from quilt.pushy_support import remote_agent
+    with _ops_lock:
+        pending = _pending.pop(env.host_string, [])
+        operations = stage_uploads([op for resource, op, root in pending])
+        while pending:
+            root = pending[0][2]
+            count = 1
+            while count < len(pending) and pending[count][2] == root:
+                count += 1
+            if root:
+                privileged_apply(pending[:count], operations[:count])
+                pending = pending[count:]
+                operations = operations[count:]
+                continue
+            packed, archive = pack_writes(operations[:count], ARCHIVE_CHUNK)
+            results = remote_agent().apply(packed, archive)
+            result = results[-1]
+            if not result['ok']:
+                # the agent stops at the first failure, as later operations
+                # may depend on it
+                failed = len(results) - 1
+                resource, op = pending[failed][0], operations[failed]
+                if result['errno'] not in (errno.EPERM, errno.EACCES):
+                    resource.abort('Could not {} {}: {}'.format(op['op'],
+                            op['path'], result['error']))
+                # the rest of the batch follows it, reading its content from
+                # where the agent staged it rather than being sent it again
+                privileged_apply(pending[failed:len(packed)],
+                        operations[failed:len(packed)], packed[failed:],
+                        result.get('archive'))
+            pending = pending[len(packed):]
+            operations = operations[len(packed):]
+
+def requires_root(op):
+    """
+    Returns whether the facts gathered so far show that the remote user can't
+    perform `op`: it gives a path to another user, changes a path that belongs
+    to another user, or adds to or removes from a directory the remote user
+    can't write to.
+    """
+    host = env.host_string
+    uid = _remote_uids.get(host)
+    if not uid:
+        return False
+    if op.get('uid', -1) not in (-1, uid):
+        return True
+    if op['op'] in ('chmod', 'utime', 'chown'):
+        facts = _facts.get((host, op['path']))
+        return bool(facts and facts['exists'] and facts['uid'] != uid)
+    parent = _facts.get((host, os.path.dirname(op['path'])))
+    return bool(parent and parent['exists'] and not parent['writable'])
+
+def privileged_apply(pending, operations, packed=None, staged_archive=None):
+    """
+    Applies operations the remote session isn't permitted to perform, in the
+    privileged session, a batch (of up to ARCHIVE_CHUNK of content) per call,
+    or one by one with sudo if there is none. `packed` operations may refer to an archive an earlier call to
+    the agent left at `staged_archive`.
+    """
+    from quilt.pushy_support import remote_agent, privileged_agent
+    agent = privileged_agent()
+    if agent is None:
+        if staged_archive:
+            remote_agent().apply([{'op': 'remove', 'path': staged_archive}])
+        for (resource, _, _), op in zip(pending, operations):
+            resource.sudo_apply(op)
+        return
+    while pending:
+        if packed is None:
+            packed, archive = pack_writes(operations, ARCHIVE_CHUNK)
+            results = agent.apply(packed, archive)
+        else:
+            results = agent.apply(packed, None, staged_archive)
+        result = results[-1]
+        if not result['ok']:
+            resource, op = pending[len(results) - 1][0], operations[len(results) - 1]
+            resource.abort('Could not {} {}: {}'.format(op['op'], op['path'],
+                    result['error']))
+        pending = pending[len(packed):]
+        operations = operations[len(packed):]
+        packed = None
+
+def simulate(op):
+    """
+    Updates the cached facts as if `op` had been applied, so that planning
+    can carry on from the state the host will be in. Paths it creates belong
+    to the remote user until chowned, and only those it owns are writable.
+    """
+    host = env.host_string
+    facts = _facts.setdefault((host, op['path']), {
+        'exists': False, 'type': None, 'uid': None, 'gid': None, 'mode': None,
+        'readable': True, 'writable': True, 'sha256': None, 'size': None,
+        'empty': None,
+    })
+    kind = op['op']
+    created = kind in ('mkdir', 'write', 'symlink') and not facts['exists']
+    if created:
+        facts.update({'exists': True, 'uid': _remote_uids.get(host)})
+    if kind in ('mkdir', 'write', 'symlink'):
+        parent = _facts.get((host, os.path.dirname(op['path'])))
+        if parent:
+            parent['empty'] = False
+    if kind == 'mkdir':
+        facts.update({'type': 'directory', 'mode': op['mode'], 'empty': True})
+    elif kind == 'write':
+        if 'content' in op:
+            sha256, size = hashlib.sha256(op['content']).hexdigest(), len(op['content'])
+        else:
+            sha256, size = source_hash(op['source']), os.path.getsize(op['source'])
+        facts.update({'type': 'file', 'mode': op['mode'], 'sha256': sha256,
+                'size': size})
+    elif kind == 'symlink':
+        facts['type'] = 'symlink'
+    elif kind == 'chmod':
+        facts['mode'] = op['mode']
+    elif kind == 'remove':
+        facts.update({'exists': False, 'type': None})
+    for key in ('uid', 'gid'):
+        if op.get(key, -1) != -1:
+            facts[key] = op[key]
+    uid = _remote_uids.get(host)
+    if created or (facts['exists'] and op.get('uid', -1) != -1):
+        if uid in (None, 0, facts['uid']):
+            facts.update({'readable': True, 'writable': True})
+        else:
+            facts.update({'writable': False,
+                'readable': bool((facts['mode'] or 0) & stat.S_IROTH)})
+
+def check_manifest(resources):
+    """
+    Looks up the incremental resources among `resources` in the current
+    host's manifest, and returns those that still need to be checked. The
+    others were converged by an earlier run, and neither their settings nor
+    their paths have changed since.
+    """
+    from quilt.pushy_support import remote_agent
+    manifest = env.resources.fs.manifest
+    if not manifest:
+        return resources
+    entries = {}
+    for r in resources:
+        if r.incremental:
+            entries[r.key] = [r.path, r.desired_hash()]
+    if not entries:
+        return resources
+    unchanged = set(remote_agent().check_manifest(manifest, entries))
+    host = env.host_string
+    _unchanged[host] = unchanged
+    if not simulating():
+        # once ensured, changed resources are recorded with their new state
+        _manifest_entries[host] = dict((key, entry)
+                for key, entry in entries.iteritems() if key not in unchanged)
+    return [r for r in resources if r.key not in unchanged]
+
+def record_manifest():
+    """
+    Records the entries queued by `check_manifest` in the current host's
+    manifest, and mirrors it locally if env.resources.fs.manifest_mirror is
+    set.
+    """
+    from quilt.pushy_support import remote_agent
+    host = env.host_string
+    _unchanged.pop(host, None)
+    entries = _manifest_entries.pop(host, None)
+    if not entries:
+        return
+    mirror = env.resources.fs.manifest_mirror
+    result = remote_agent().update_manifest(env.resources.fs.manifest, entries,
+            bool(mirror))
+    if result is None:
+        warn('Could not write the manifest on {}'.format(host))
+    elif mirror:
+        if not os.path.isdir(mirror):
+            os.makedirs(mirror)
+        with open(os.path.join(mirror, '{}.json'.format(host)), 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+
+def converged(key):
+    """
+    Returns whether a resource key or path has been (or is being) converged on
+    the current host in this run.
+    """
+    return key in _converged.get(env.host_string, ())
+
+def wait_converged(key):
+    """
+    Waits until a resource key or path being converged in another thread has
+    had its changes queued, so that changes queued after them can depend on
+    them.
+    """
+    claim = _converged.get(env.host_string, {}).get(key)
+    if claim and claim[0] is not threading.current_thread():
+        claim[1].wait()
+
+@contextmanager
+def converging(resource):
+    """
+    Context manager around converging a resource's path, which yields
+    whether that is still to be done in this run. If another thread is
+    converging the same key or path, it waits for that to be done first.
+    """
+    host = env.host_string
+    claim = None
+    with _ops_lock:
+        index = _converged.get(host)
+        if index is None and (_batch_depth.get(host) or simulating()):
+            index = _converged[host] = {}
+        if index is not None:
+            claim = index.get(resource.key) or index.get(resource.path)
+        first = claim is None
+        if first:
+            claim = (threading.current_thread(), threading.Event())
+            if index is not None:
+                index[resource.key] = index[resource.path] = claim
+    if not first:
+        if claim[0] is not threading.current_thread():
+            claim[1].wait()
+        yield False
+        return
+    try:
+        yield True
+    finally:
+        claim[1].set()
+
+@after_planning
+def forget_facts(host):
+    for key in [k for k in _facts if k[0] == host]:
+        del _facts[key]
+    _unchanged.pop(host, None)
+    _converged.pop(host, None)
+
+@before_run
+def forget_host(host):
+    # the host may have changed since the last run
+    forget_facts(host)
+    _identities.pop(host, None)
+    _runs[host] = _runs.get(host, 0) + 1
+
+def source_hash(path):
+    """
+    Returns the sha256 of a local file, read a chunk at a time. Digests are
+    kept until the file's size or mtime changes.
+    """
+    from quilt.agent import file_hash
+    st = os.stat(path)
+    cached = _source_hashes.get(path)
+    if cached and cached[:2] == (st.st_size, int(st.st_mtime)):
+        return cached[2]
+    sha256 = file_hash(path, STREAM_CHUNK)
+    _source_hashes[path] = (st.st_size, int(st.st_mtime), sha256)
+    return sha256
+
+def spool(chunks):
+    """
+    Collects chunks of content (str or unicode), returning ('content', data)
+    if they add up to no more than STREAM_THRESHOLD, or else ('source', path)
+    of a local temporary file holding them.
+    """
+    buffered = []
+    size = 0
+    f = None
+    for chunk in chunks:
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode('utf-8')
+        if f is not None:
+            f.write(chunk)
+            continue
+        buffered.append(chunk)
+        size += len(chunk)
+        if size > STREAM_THRESHOLD:
+            f = tempfile.NamedTemporaryFile(prefix='quilt-')
+            f.writelines(buffered)
+            buffered = None
+    if f is None:
+        return 'content', ''.join(buffered)
+    f.flush()
+    _spool_files.append(f)
+    return 'source', f.name
+
+def stage_uploads(operations):
+    """
+    Uploads the content of writes from local files larger than
+    STREAM_THRESHOLD ahead of applying them, a chunk per call, so that
+    neither side holds a whole file in memory. Returns the operations with
+    those writes naming their `staged` remote copy.
+    """
+    from quilt.pushy_support import remote_agent
+    staged = []
+    for op in operations:
+        if (op['op'] == 'write' and 'source' in op and 'staged' not in op
+                and os.path.getsize(op['source']) > STREAM_THRESHOLD):
+            path = None
+            with open(op['source'], 'rb') as f:
+                for chunk in iter(lambda: f.read(STREAM_CHUNK), ''):
+                    path = remote_agent().stage(chunk, path)
+            if path is None:
+                path = remote_agent().stage('')
+            op = dict(op, staged=path)
+        staged.append(op)
+    return staged
+
+def pack_writes(operations, limit=None):
+    """
+    Moves the content of write operations into a single gzipped tar archive,
+    so a batch of uploads travels as one compressed stream. Returns the new
+    operations and the archive (None when there is nothing to pack). Writes
+    already staged by `stage_uploads` are left out.
+
+    Once `limit` bytes of content have been packed, the operations after
+    that are left out too, for the caller to pack in another archive.
+    """
+    import tarfile
+    if not [op for op in operations
+            if op['op'] == 'write' and 'staged' not in op]:
+        return [strip_source(op) for op in operations], None
+    buf = StringIO()
+    tar = tarfile.open(fileobj=buf, mode='w:gz')
+    packed = []
+    size = 0
+    for i, op in enumerate(operations):
+        if limit is not None and size >= limit:
+            break
+        if op['op'] == 'write' and 'staged' in op:
+            op = strip_source(op)
+        elif op['op'] == 'write' and 'source' in op:
+            with open(op['source'], 'rb') as f:
+                info = tar.gettarinfo(op['source'], str(i), f)
+                tar.addfile(info, f)
+            size += info.size
+            op = dict(op, member=str(i))
+            del op['source']
+        elif op['op'] == 'write':
+            info = tarfile.TarInfo(str(i))
+            info.size = len(op['content'])
+            info.mode = op['mode']
+            tar.addfile(info, StringIO(op['content']))
+            size += info.size
+            op = dict(op, member=str(i))
+            del op['content']
+        packed.append(op)
+    tar.close()
+    return packed, buf.getvalue()
+
+def strip_source(op):
+    # local paths mean nothing to the agent
+    if 'source' in op:
+        op = dict(op)
+        del op['source']
+    return op
+
+def get_identities():
+    """
+    Returns the current host's user and group tables, as a dict with 'users'
+    and 'groups' name -> id maps.
+    """
+    gather_facts([], identities=True)
+    return _identities[env.host_string]
+
+def invalidate_identities():
+    """
+    Discards the current host's user and group tables. Resources that create
+    users or groups must call this so later lookups see them.
+    """
+    _identities.pop(env.host_string, None)
+
+def lookup_id(kind, name):
+    """
+    Returns the id of the named user or group ('users' or 'groups' kind), or
+    None if it does not exist.
+    """
+    from quilt.pushy_support import remote_agent
+    table = get_identities()[kind]
+    if name not in table:
+        # some NSS backends (eg, LDAP) don't enumerate all of their entries
+        if kind == 'users':
+            result = remote_agent().lookup_ids([name], [])
+        else:
+            result = remote_agent().lookup_ids([], [name])
+        table.update(result[kind])
+    return table[name]
+
+def get_template_env(path):
+    """
+    Returns the shared jinja2 environment for templates in `path`. Compiled
+    templates are kept for the life of the process and recompiled when the
+    template file's mtime changes.
+    """
+    import jinja2
+    if path not in _template_envs:
+        bytecode_cache = None
+        if env.template_cache_dir:
+            bytecode_cache = jinja2.FileSystemBytecodeCache(env.template_cache_dir)
+        tplenv = jinja2.Environment(loader=jinja2.FileSystemLoader(path),
+                bytecode_cache=bytecode_cache, auto_reload=True, cache_size=-1)
+        _template_envs.setdefault(path, tplenv)
+    return _template_envs[path]
 
 class File(Resource):
     path = None
     template = None
+    # a string, a file-like object or an iterable of strings
     content = None
+    # local file to copy, in place of content or template
+    source = None
     owner = None
     group = None
     mode = None
     target = None
     newlines = None
     no_update = None
+    diff_limit = None
 
     directory = False
     symlink = False
+    # whether the manifest may skip this resource when it is unchanged; off
+    # for resources whose ensure does more than converge their path
+    incremental = True
+    # paths are claimed (see `converging`) and operations queued under
+    # _ops_lock, which also serializes hiding Fabric's output
+    threadsafe = True
     
     def __init__(self, *args, **kwargs):
         super(File, self).__init__(*args, **kwargs)
         if not self.path:
             self.path = self.name
-        self.__dummy_exists = False
+
+    @classmethod
+    def batch(cls):
+        return batch()
+
+    @classmethod
+    def prefetch(cls, resources):
+        paths = []
+        identities = False
+        for r in resources:
+            r.clean()
+        for r in check_manifest(resources):
+            paths.extend(r.fact_paths())
+            if isinstance(r.owner, basestring) or isinstance(r.group, basestring):
+                identities = True
+        gather_facts(paths, identities)
+
+    def provides(self):
+        return super(File, self).provides() + [('path', self.path)]
+
+    def dependencies(self):
+        deps = super(File, self).dependencies()
+        path = os.path.dirname(self.path)
+        while path != '/':
+            deps.append(('path', path))
+            path = os.path.dirname(path)
+        return deps
+
+    def desired_state(self):
+        """
+        Returns the settings this resource converges its path to, as recorded
+        (hashed) in the manifest.
+        """
+        state = {
+            'type': self.directory and 'directory' or self.symlink and 'symlink' or 'file',
+            'path': self.path,
+            'target': self.target,
+            'owner': self.owner,
+            'group': self.group,
+            'mode': self.mode,
+            'no_update': self.no_update,
+        }
+        if not self.directory and not self.symlink and not self.no_update:
+            state['content'] = self.content_hash()
+        return state
+
+    def desired_hash(self):
+        state = json.dumps(self.desired_state(), sort_keys=True)
+        return hashlib.sha256(state).hexdigest()
+
+    def fact_paths(self):
+        """
+        Paths whose facts are gathered together with this resource's.
+        """
+        return [self.path]
+
+    def get_facts(self, subpath=None):
+        """
+        Returns the remote facts record for this path (or a subpath of it).
+        """
+        path = self.path
+        if subpath:
+            path = os.path.join(path, subpath)
+        key = (env.host_string, path)
+        if key not in _facts:
+            paths = self.fact_paths()
+            if path not in paths:
+                paths.append(path)
+            gather_facts(paths)
+        return _facts[key]
+
+    def invalidate_facts(self):
+        """
+        Discards cached facts for this path after it has been changed.
+        """
+        for path in self.fact_paths():
+            _facts.pop((env.host_string, path), None)
     
     def clean(self):
         self.require('path')
@@ -47,171 +636,267 @@ class File(Resource):
             self.path = self.path[:-1]
 
     def ensure(self, parents=False):
-        remote_os = self.remote_import('os')
         self.clean()
+        with converging(self) as pending:
+            if pending and self.key not in _unchanged.get(env.host_string, ()):
+                self.ensure_path(parents)
+
+    def ensure_path(self, parents=False):
+        """
+        Converges the path, once per run (see `ensure`).
+        """
         parent, name = os.path.split(self.path)
 
         if parents and parent != '/':
             self.ensure_parents()
         
-        if not self.exists():
-            if not env.dry_run:
-                if self.directory:
-                    self.log('Creating directory {} with mode {}'.format(self.path, oct(self.mode)))
-                    cmd = 'mkdir -m {} {}'.format(oct(self.mode), self.path)
-                    _run = remote_os.access(parent, os.W_OK) and run or sudo
-                    _run(cmd)
-                elif self.symlink:
-                    self.log('Creating symlink {} -> {}'.format(self.target, self.path))
-                    cmd = 'ln -s {} {}'.format(self.target, self.path)
-                    _run = remote_os.access(parent, os.W_OK) and run or sudo
-                    _run(cmd)
-                else:
-                    self.log('Creating file {} with mode {}'.format(self.path, oct(self.mode)))
-                    content = StringIO(self.get_content())
-                    use_sudo = not remote_os.access(self.path, os.W_OK)
-                    put(content, self.path, use_sudo=use_sudo, mode=self.mode)
+        facts = self.get_facts()
+        if not facts['exists']:
+            if self.directory:
+                self.log('Creating directory {} with mode {}'.format(self.path, oct(self.mode)))
+                self.apply({'op': 'mkdir', 'path': self.path, 'mode': self.mode})
+                self.apply({'op': 'chown', 'path': self.path,
+                        'uid': self.get_uid(self.owner),
+                        'gid': self.get_gid(self.group)})
+            elif self.symlink:
+                self.log('Creating symlink {} -> {}'.format(self.target, self.path))
+                self.apply({'op': 'symlink', 'path': self.path, 'target': self.target})
             else:
-                self._dummy_exists = True
-        else:
-            # assert correct node type (file/directory/symlink)
-            islink = remote_os.path.islink(self.path)
-            isdir = remote_os.path.isdir(self.path)
-            
-            if self.symlink:
-                if not islink:
-                    self.abort("{} should be symlink but is not".format(self.path))
-            elif self.directory:
-                if islink or not isdir:
-                    self.abort("{} should be a directory but is not".format(self.path))
-            elif islink or isdir:
-                self.abort("{} should be a regular file, but is not".format(self.path))
-
-        if env.dry_run:
-            _dummy_exists = self._dummy_exists
-            self._dummy_exists = False
-            actually_exists = self.exists()
-            self._dummy_exists = _dummy_exists
-            if not actually_exists:
-                # if this a dry run and the file is being created,
-                # there's nothing else we can do
-                return 
+                self.log('Creating file {} with mode {}'.format(self.path, oct(self.mode)))
+                self.write_content()
+            return
+
+        # assert correct node type (file/directory/symlink)
+        islink = facts['type'] == 'symlink'
+        isdir = facts['type'] == 'directory'
         
-        if self.exists():
-            regular_file = not self.directory and not self.symlink
-            if regular_file and not self.no_update:
-                diff = self.diff()
-                if diff:
-                    self.log('Updating file {}: \n{}'.format(self.path, diff))
-                    if not env.dry_run:
-                        content = StringIO(self.get_content())
-                        use_sudo = not remote_os.access(self.path, os.W_OK)
-                        put(content, self.path, use_sudo=use_sudo, mode=self.mode)
-
-            # check ownership
-            current_stat = remote_os.stat(self.path)
-            current_uid = current_stat.st_uid
-            current_gid = current_stat.st_gid
-            uid = self.get_uid(self.owner)
-            gid = self.get_gid(self.group)
-            if current_uid != uid or current_gid != gid:
-                self.chown(self.owner, self.group)
-
-            # check file mode
-            current_mode = stat.S_IMODE(current_stat.st_mode)
-            # if our required mode does not specify setuid/setgid, then we don't
-            # care if the resource has it.
-            if not self.mode & stat.S_ISUID and current_mode & stat.S_ISUID:
-                current_mode = current_mode ^ stat.S_ISUID
-            if not self.mode & stat.S_ISGID and current_mode & stat.S_ISGID:
-                current_mode = current_mode ^ stat.S_ISGID
-            if oct(current_mode) != oct(self.mode):
-                self.chmod(self.mode)
+        if self.symlink:
+            if not islink:
+                self.abort("{} should be symlink but is not".format(self.path))
+        elif self.directory:
+            if islink or not isdir:
+                self.abort("{} should be a directory but is not".format(self.path))
+        elif islink or isdir:
+            self.abort("{} should be a regular file, but is not".format(self.path))
+
+        regular_file = not self.directory and not self.symlink
+        if regular_file and not self.no_update:
+            diff = self.diff()
+            if diff:
+                self.log('Updating file {}: \n{}'.format(self.path, diff))
+                # the new content is written with the right owner and mode
+                self.write_content()
+                return
+
+        # check ownership
+        uid = self.get_uid(self.owner)
+        gid = self.get_gid(self.group)
+        if facts['uid'] != uid or facts['gid'] != gid:
+            self.chown(self.owner, self.group)
+
+        # check file mode
+        current_mode = facts['mode']
+        # if our required mode does not specify setuid/setgid, then we don't
+        # care if the resource has it.
+        if not self.mode & stat.S_ISUID and current_mode & stat.S_ISUID:
+            current_mode = current_mode ^ stat.S_ISUID
+        if not self.mode & stat.S_ISGID and current_mode & stat.S_ISGID:
+            current_mode = current_mode ^ stat.S_ISGID
+        if oct(current_mode) != oct(self.mode):
+            self.chmod(self.mode)
+
+    def write_content(self):
+        kind, value = self.content_source()
+        self.apply({'op': 'write', 'path': self.path, kind: value,
+                'mode': self.mode, 'uid': self.get_uid(self.owner),
+                'gid': self.get_gid(self.group)})
+
+    def apply(self, op):
+        """
+        Runs a filesystem operation through the remote agent. Inside a batch
+        (see `batch`), the operation is queued and sent along with the others.
+        While planning, it is recorded as a change and simulated instead.
+        """
+        if simulating():
+            self.change({'action': 'fs', 'op': op})
+            simulate(op)
+            return
+        host = env.host_string
+        with _ops_lock:
+            # decided now, while the facts about the path are still cached
+            _pending.setdefault(host, []).append((self, op, requires_root(op)))
+            batched = _batch_depth.get(host)
+        self.notify()
+        self.invalidate_facts()
+        parent = _facts.get((host, os.path.dirname(op['path'])))
+        if parent and op['op'] in ('mkdir', 'write', 'symlink'):
+            parent['empty'] = False
+        elif parent and op['op'] == 'remove':
+            del _facts[(host, os.path.dirname(op['path']))]
+        if not batched:
+            flush()
+
+    def apply_change(self, change):
+        if change['action'] == 'fs':
+            return self.apply(change['op'])
+        return super(File, self).apply_change(change)
+
+    def dump_change(self, change):
+        # spooled content lives in temporary files of this process only
+        op = change.get('op')
+        if (change['action'] == 'fs' and op['op'] == 'write' and 'source' in op
+                and op['source'] in [f.name for f in _spool_files]):
+            with open(op['source'], 'rb') as f:
+                op = dict(strip_source(op), content=f.read())
+            change = dict(change, op=op)
+        return super(File, self).dump_change(change)
+
+    def sudo_apply(self, op):
+        """
+        Runs an operation the remote session was not permitted to, using sudo.
+        """
+        kind, path = op['op'], op['path']
+        if kind == 'mkdir':
+            sudo('mkdir -m {} {}'.format(oct(op['mode']), path))
+        elif kind == 'write':
+            if 'source' in op:
+                put(op['source'], path, use_sudo=True, mode=op['mode'])
+            else:
+                put(StringIO(op['content']), path, use_sudo=True, mode=op['mode'])
+            if 'staged' in op:
+                sudo('rm -f {}'.format(op['staged']))
+            sudo('chown {}:{} {}'.format(op['uid'], op['gid'], path))
+            if op.get('mtime') is not None:
+                sudo('touch -d @{} {}'.format(op['mtime'], path))
+        elif kind == 'symlink':
+            sudo('ln -s {} {}'.format(op['target'], path))
+        elif kind == 'chmod':
+            sudo('chmod {} {}'.format(oct(op['mode']), path))
+        elif kind == 'utime':
+            sudo('touch -d @{} {}'.format(op['mtime'], path))
+        elif kind == 'chown':
+            ids = [str(i) for i in (op['uid'], op['gid']) if i != -1]
+            if op['uid'] == -1:
+                ids.insert(0, '')
+            sudo('chown {}{} {}'.format((op.get('recursive') and '--recursive ' or ''),
+                    ':'.join(ids), path))
+        elif kind == 'remove':
+            sudo('if [ -d {0} ] && [ ! -L {0} ]; then rmdir {0}; else rm {0}; fi'.format(
+                    path))
 
     def ensure_parents(self):
-        parent, name = os.path.split(self.path)
-        Directory(parent).ensure(parents=True)
+        """
+        Ensures the ancestors of this path up to the nearest one converged in
+        this run. Their facts are gathered together, so that a missing chain
+        is created in a single batch.
+        """
+        parents = []
+        path = os.path.dirname(self.path)
+        while path != '/' and not converged(path):
+            parents.insert(0, Directory(path))
+            path = os.path.dirname(path)
+        wait_converged(path)
+        if not parents:
+            return
+        for directory in parents:
+            directory.clean()
+        gather_facts([directory.path for directory in parents])
+        with batch():
+            for directory in parents:
+                directory.ensure()
     
     def chmod(self, mode):
-        remote_os = self.remote_import('os')
-        current_stat = remote_os.stat(self.path)
-        current_mode = stat.S_IMODE(remote_os.stat(self.path).st_mode)
+        current_mode = self.get_facts()['mode']
 
         self.log('Changing permissions on {} from {} to {}'.format(self.path,
-                oct(current_mode), oct(self.mode)))
+                oct(current_mode), oct(mode)))
 
-        if env.dry_run:
-            return
-
-        cmd = 'chmod {} {}'.format(oct(self.mode), self.path)
-
-        # See if we have write permissions on this path
-        if current_stat.st_uid == remote_os.getuid():
-            run(cmd)
-        else:
-            sudo(cmd)
+        self.apply({'op': 'chmod', 'path': self.path, 'mode': mode})
 
     def chown(self, owner, group=None, recursive=False):
-        remote_os = self.remote_import('os')
-        current_stat = remote_os.stat(self.path)
         chown_str = group and '{}:{}'.format(owner, group) or owner
 
         self.log('Setting {}ownership to {} on {}'.format( 
                 (recursive and 'recursive ' or ''), chown_str, self.path))
         
-        owner_changed = self.get_uid(owner) != current_stat.st_uid
-
-        if env.dry_run:
-            return
-
-        if owner_changed:
-            sudo('chown {}{} {}'.format((recursive and '--recursive ' or ''),
-                    chown_str, self.path))
-        elif group:
-            cmd = 'chgrp {} {}'.format(group, self.path)
-            if current_stat.st_uid == remote_os.getuid():
-                run(cmd)
-            else:
-                sudo(cmd)
+        gid = -1
+        if group:
+            gid = self.get_gid(group)
+        self.apply({'op': 'chown', 'path': self.path, 'uid': self.get_uid(owner),
+                'gid': gid, 'recursive': recursive})
 
     def get_uid(self, user):
         if type(user) == int:
             return user
         if not isinstance(user, basestring):
             self.abort('Invalid user name: {}'.format(user))
-        pwd = self.remote_import('pwd')
-        try:
-            return pwd.getpwnam(user)[2]
-        except KeyError:
+        uid = lookup_id('users', user)
+        if uid is None:
             self.abort('User "{}" not found'.format(user))
+        return uid
 
     def get_gid(self, group):
         if type(group) == int:
             return group
         if not isinstance(group, basestring):
             self.abort('Invalid group name: {}'.format(group))
-        grp = self.remote_import('grp')
-        try:
-            return grp.getgrnam(group)[2]
-        except KeyError:
+        gid = lookup_id('groups', group)
+        if gid is None:
             self.abort('Group "{}" not found'.format(group))
+        return gid
  
 
     def get_content(self):
-        if self.content is not None:
-            return self.content
-
-        if self.template:
-            return self.render_template()
+        kind, value = self.content_source()
+        if kind == 'source':
+            with open(value, 'rb') as f:
+                return f.read()
+        return value
 
-        return ''
+    def content_source(self):
+        """
+        Returns ('content', data) or ('source', local path) for what this
+        file should contain. Content larger than STREAM_THRESHOLD is spooled
+        to a local temporary file, so that it is uploaded a chunk at a time;
+        streamed content (file-like objects, iterables and templates) is
+        never held in memory whole.
+        """
+        if self.source:
+            return 'source', os.path.expanduser(self.source)
+        content = self.content
+        if isinstance(content, basestring) and len(content) <= STREAM_THRESHOLD:
+            if isinstance(content, unicode):
+                return 'content', content.encode('utf-8')
+            return 'content', content
+        if content is None and not self.template:
+            return 'content', ''
+        if content is None:
+            # the context may change between runs, so render once per run
+            key = (self.template, env.host_string, _runs.get(env.host_string))
+        else:
+            # streams can only be read once, so what they produced is kept
+            key = content
+        spooled = getattr(self, '_spooled', None)
+        if spooled is None or spooled[0] != key:
+            if content is None:
+                chunks = self.render_template(stream=True)
+            elif isinstance(content, basestring):
+                chunks = [content]
+            elif hasattr(content, 'read'):
+                chunks = iter(lambda: content.read(STREAM_CHUNK), '')
+            else:
+                chunks = content
+            spooled = self._spooled = (key, spool(chunks))
+        return spooled[1]
 
-    def render_template(self):
+    def render_template(self, stream=False):
         import jinja2
         tpl_path = self.get_template_path(self.template)
-        tplenv = jinja2.Environment(loader=jinja2.FileSystemLoader(tpl_path))
+        tplenv = get_template_env(tpl_path)
         try:
             template = tplenv.get_template(self.template)
+            if stream:
+                return template.generate(**self.__dict__)
             return template.render(**self.__dict__)
         except jinja2.exceptions.TemplateSyntaxError, e:
             self.abort('Template syntax error in {}: {}'.format(self.template, e))
@@ -221,24 +906,12 @@ class File(Resource):
         return os.path.join(os.path.dirname(module), 'templates')
 
     def exists(self, subpath=None):
-        remote_os = self.remote_import('os')
-        path = self.path
-        if subpath:
-            path = os.path.join(path, subpath)
-        return remote_os.path.exists(path) or self._dummy_exists
+        return self.get_facts(subpath)['exists']
 
     def remove(self):
         assert False
-        remote_os = self.remote_import('os')
         self.log('Removing {}'.format(self.path))
-        if env.dry_run:
-            return
-        _run = remote_os.access(self.path, os.W_OK) and run or sudo
-        if self.directory:
-            _run('rmdir {}'.format(self.path))
-        else:
-            _run = remote_os.access(self.path, os.W_OK) and run or sudo
-            _run('rm {}'.format(self.path))
+        self.apply({'op': 'remove', 'path': self.path})
 
     def fmode_to_dirmode(self, mode):
         "Returns directory-equivelant of file mode. Basically sets executible for every readable u/g/o part."
@@ -250,13 +923,49 @@ class File(Resource):
             mode = mode | stat.S_IXOTH
         return mode
 
+    def content_hash(self):
+        kind, value = self.content_source()
+        if kind == 'source':
+            return source_hash(value)
+        return hashlib.sha256(value).hexdigest()
+
+    def content_size(self):
+        kind, value = self.content_source()
+        if kind == 'source':
+            return os.path.getsize(value)
+        return len(value)
+
+    def remote_hash(self):
+        facts = self.get_facts()
+        if facts['sha256'] is not None:
+            return facts['sha256']
+        # we can't read the file in our session, so let root hash it
+        from quilt.pushy_support import privileged_agent
+        agent = privileged_agent()
+        if agent is not None:
+            return agent.file_hash(self.path)
+        with _ops_lock, hide('running', 'stdout'):
+            output = sudo('sha256sum {}'.format(self.path))
+        return output.split()[0]
+
     def diff(self):
         from difflib import unified_diff
-        remote_os = self.remote_import('os')
+        from quilt.pushy_support import remote_agent, privileged_agent
+        # Compare digests first, so unchanged files are never transferred
+        if self.remote_hash() == self.content_hash():
+            return ''
+        size = self.content_size()
+        remote_size = self.get_facts()['size'] or 0
+        if self.diff_limit is not None and max(size, remote_size) > self.diff_limit:
+            return '{} bytes, was {} bytes (not diffed)'.format(size, remote_size)
         # Get remote file's contents
-        _run = remote_os.access(self.path, os.R_OK) and run or sudo
-        with hide('running', 'stdout'):
-            current_content = _run('cat {}'.format(self.path))
+        if self.get_facts()['readable']:
+            current_content = remote_agent().read_file(self.path)
+        elif privileged_agent() is not None:
+            current_content = privileged_agent().read_file(self.path)
+        else:
+            with _ops_lock, hide('running', 'stdout'):
+                current_content = sudo('cat {}'.format(self.path))
         old = self.normalize_newlines(current_content).splitlines(True)
         new = self.normalize_newlines(self.get_content()).splitlines(True)
         diff = unified_diff(old, new, fromfile='old', tofile='new')
@@ -276,11 +985,18 @@ class File(Resource):
         is unsafe to run using sudo (such as git clone), this context manager 
         can be used.
         """
-        remote_os = self.remote_import('os')
-        if force or not remote_os.access(self.path, access):
+        # the command we're wrapping needs the path as it's meant to be
+        flush()
+        facts = self.get_facts()
+        if access == os.R_OK:
+            allowed = facts['readable']
+        else:
+            allowed = facts['writable']
+        if force or not allowed:
             if not force:
                 self.log('Current user does not have write access to {}, temporarily changing owners...'.format(self.path))
             self.chown(env.user, recursive=recursive)
+            flush()
             yield True # we needed to chown
             self.chown(self.owner, recursive=recursive)
         else:
@@ -289,12 +1005,111 @@ class File(Resource):
 
 class Directory(File): 
     directory = True
+    # local directory whose tree is copied below this one, and whether to
+    # remove remote paths that are not in it
+    source = None
+    delete = None
+
+    def clean(self):
+        super(Directory, self).clean()
+        # the manifest only records the directory itself, not the tree below
+        if self.source:
+            self.incremental = False
+
+    def ensure_path(self, parents=False):
+        super(Directory, self).ensure_path(parents)
+        if self.source:
+            self.sync()
+
+    def source_manifest(self):
+        """
+        Returns the manifest of the local source tree, relative path -> entry
+        as described in quilt.agent.compare_tree. Files are only hashed again
+        once their size or mtime changes.
+        """
+        source = os.path.expanduser(self.source)
+        if not os.path.isdir(source):
+            self.abort('source must be a local directory (got "{}")'.format(
+                    self.source))
+        entries = {}
+        for directory, dirs, files in os.walk(source):
+            relative = os.path.relpath(directory, source)
+            for name in dirs + files:
+                path = os.path.join(directory, name)
+                rel = os.path.normpath(os.path.join(relative, name))
+                st = os.lstat(path)
+                mode = stat.S_IMODE(st.st_mode)
+                if stat.S_ISLNK(st.st_mode):
+                    entries[rel] = ['symlink', os.readlink(path)]
+                elif stat.S_ISDIR(st.st_mode):
+                    entries[rel] = ['directory', mode]
+                elif stat.S_ISREG(st.st_mode):
+                    entries[rel] = ['file', mode, st.st_size,
+                            int(st.st_mtime), source_hash(path)]
+        return entries
+
+    def sync(self):
+        """
+        Copies the local source tree below this directory, comparing both in
+        a single call and sending only new and changed files. Paths not in
+        the source are removed if `delete` is set.
+        """
+        from quilt.pushy_support import remote_agent
+        entries = self.source_manifest()
+        source = os.path.expanduser(self.source)
+        uid = self.get_uid(self.owner)
+        gid = self.get_gid(self.group)
+        # the comparison must see any changes queued for the tree
+        flush()
+        changes = remote_agent().compare_tree(self.path, entries, uid, gid,
+                bool(self.delete))
+        if not changes:
+            return
+        counts = {}
+        for rel, reason in changes:
+            counts[reason] = counts.get(reason, 0) + 1
+        self.log('Syncing {} from {}: {}'.format(self.path, self.source,
+                ', '.join('{} {}'.format(n, reason)
+                    for reason, n in sorted(counts.items()))))
+
+        with batch():
+            for rel, reason in changes:
+                path = os.path.join(self.path, rel)
+                entry = entries.get(rel)
+                if reason in ('extra', 'extra_dir'):
+                    self.apply({'op': 'remove', 'path': path})
+                elif reason == 'type':
+                    self.abort('{} should be a {} but is not'.format(path,
+                            entry[0]))
+                elif entry[0] == 'symlink':
+                    if reason == 'content':
+                        self.apply({'op': 'remove', 'path': path})
+                    self.apply({'op': 'symlink', 'path': path,
+                            'target': entry[1]})
+                elif reason == 'missing' and entry[0] == 'directory':
+                    self.apply({'op': 'mkdir', 'path': path, 'mode': entry[1]})
+                    self.apply({'op': 'chown', 'path': path, 'uid': uid,
+                            'gid': gid})
+                elif reason in ('missing', 'content'):
+                    self.apply({'op': 'write', 'path': path,
+                            'source': os.path.join(source, rel),
+                            'mode': entry[1], 'uid': uid, 'gid': gid,
+                            'mtime': entry[3]})
+                elif reason == 'mtime':
+                    self.apply({'op': 'utime', 'path': path, 'mtime': entry[3]})
+                elif reason == 'mode':
+                    self.apply({'op': 'chmod', 'path': path, 'mode': entry[1]})
+                elif reason == 'owner':
+                    self.apply({'op': 'chown', 'path': path, 'uid': uid,
+                            'gid': gid})
 
     def is_empty(self):
-        if not self.exists():
+        facts = self.get_facts()
+        if not facts['exists']:
             return True
-        remote_os = self.remote_import('os')
-        return remote_os.listdir(self.path) == []
+        if facts['empty'] is None:
+            self.abort('Cannot list contents of {}'.format(self.path))
+        return facts['empty']
 
     def recursive_chmod(self, chmod_arg, use_sudo=False):
         cmd = 'chmod --recursive {} {}'.format(chmod_arg, use_sudo)
@@ -306,6 +1121,13 @@ class Directory(File):
 class Symlink(File):
     symlink = True
 
+    def dependencies(self):
+        deps = super(Symlink, self).dependencies()
+        if self.target:
+            target = os.path.join(os.path.dirname(self.path), self.target)
+            deps.append(('path', os.path.normpath(target)))
+        return deps
+
     def clean(self):
         super(Symlink, self).clean()
         self.require('target')
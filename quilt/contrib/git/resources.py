@@ -1,16 +1,138 @@
-from fabric.api import abort, run, show
+import os
+import re
+import hashlib
+from fabric.api import abort, run, show, hide, env
 from quilt.contrib import fs
+from quilt.resources import simulating
+
+# Directory on each host for bare mirrors of the repositories cloned there,
+# which clones borrow objects from with --reference (disabled when None)
+env.resources.git.clone.reference = None
+
+SHA = re.compile(r'^[0-9a-f]{40}$')
 
 class Clone(fs.Directory):
     repo = None
+    # branch, tag or commit to check out; existing clones are only updated
+    # when it is set
+    revision = None
+    # history depth for shallow clones, and a --filter for partial ones
+    # (eg. 'blob:none')
+    depth = None
+    filter = None
+    reference = None
+    incremental = False
+    # runs commands with changed Fabric settings
+    threadsafe = False
+
+    def fact_paths(self):
+        return [self.path, os.path.join(self.path, '.git')]
 
     def ensure(self):
         super(Clone, self).ensure()
         if not self.exists('.git'):
             if self.is_empty():
-                cmd = 'git clone {} {}; logout'.format(self.repo, self.path)
                 with self.temp_ownership(recursive=True):
-                    with show('stdout', 'stderr'):
-                        run(cmd)
+                    self.change({'action': 'clone',
+                            'command': self.clone_command()})
+                if simulating():
+                    fs.simulate({'op': 'mkdir', 'path': os.path.join(self.path, '.git'),
+                            'mode': self.mode})
             else:
                 abort('Git directory is not empty and is not a git repository')
+        elif self.revision:
+            from quilt.pushy_support import remote_agent
+            commit = self.remote_commit()
+            if remote_agent().git_head(self.path) != commit:
+                self.log('Updating {} to {} ({})'.format(self.path,
+                        self.revision, commit[:12]))
+                with self.temp_ownership(recursive=True):
+                    self.change({'action': 'update',
+                            'command': self.update_command(commit)})
+
+    def remote_commit(self):
+        """
+        Returns the commit `revision` names, asking the repository with git
+        ls-remote unless it is a commit id already.
+        """
+        if SHA.match(self.revision):
+            return self.revision
+        with hide('running', 'stdout'):
+            output = run("git ls-remote {0} {1} '{1}^{{}}'".format(self.repo,
+                    self.revision))
+        refs = {}
+        for line in output.splitlines():
+            fields = line.split()
+            if len(fields) == 2 and SHA.match(fields[0]):
+                refs[fields[1]] = fields[0]
+        # annotated tags are peeled to the commit they point at
+        for ref in ('refs/heads/{}', 'refs/tags/{}^{{}}', 'refs/tags/{}', '{}'):
+            ref = ref.format(self.revision)
+            if ref in refs:
+                return refs[ref]
+        abort('Revision {} not found in {}'.format(self.revision, self.repo))
+
+    def reference_path(self):
+        if self.reference:
+            name = hashlib.sha1(self.repo).hexdigest()[:16]
+            return os.path.join(self.reference, '{}.git'.format(name))
+
+    def mirror_command(self):
+        """
+        Returns a command bringing the host's mirror of the repository up to
+        date, cloning it the first time. Clones borrow the mirror's objects,
+        so refs are never pruned from it, and neither are objects by gc.
+        """
+        mirror = self.reference_path()
+        return ('mkdir -p {0} && if [ ! -d {1} ]; then '
+                'git clone -q --mirror {2} {1} && '
+                'git --git-dir={1} config gc.auto 0 && '
+                'git --git-dir={1} config gc.pruneExpire never; fi && '
+                'git --git-dir={1} fetch -q origin').format(self.reference,
+                mirror, self.repo)
+
+    def fetch_args(self):
+        args = ''
+        if self.depth:
+            args += ' --depth {}'.format(self.depth)
+        if self.filter:
+            args += ' --filter={}'.format(self.filter)
+        return args
+
+    def clone_command(self):
+        commands = []
+        args = self.fetch_args()
+        if self.reference:
+            commands.append(self.mirror_command())
+            args += ' --reference {}'.format(self.reference_path())
+        if self.revision and not SHA.match(self.revision):
+            args += ' -b {}'.format(self.revision)
+        commands.append('git clone{} {} {}'.format(args, self.repo, self.path))
+        if self.revision and SHA.match(self.revision):
+            commands.append(self.checkout_command(self.revision))
+        return ' && '.join(commands)
+
+    def update_command(self, commit):
+        commands = []
+        if self.reference:
+            commands.append(self.mirror_command())
+        commands.append(self.checkout_command(commit))
+        return ' && '.join(commands)
+
+    def checkout_command(self, commit):
+        """
+        Returns a command fetching `revision` into the clone (only what is
+        missing, or `depth` commits) and checking out `commit`.
+        """
+        return 'cd {} && git fetch -q{} origin {} && git checkout -q --force {}'.format(
+                self.path, self.fetch_args(), self.revision, commit)
+
+    def apply_change(self, change):
+        if change['action'] in ('clone', 'update'):
+            # the clone needs the directory changes made so far
+            fs.flush()
+            with show('stdout', 'stderr'):
+                run(change['command'])
+            self.invalidate_facts()
+            return
+        return super(Clone, self).apply_change(change)
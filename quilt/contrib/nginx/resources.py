@@ -1,6 +1,7 @@
 import os
 from quilt.contrib import fs
-from fabric.api import env
+from quilt.resources import handler
+from fabric.api import env, sudo
 
 env.resources.nginx.conf_dir = '/etc/nginx'
 env.resources.nginx.conf_owner = 'root'
@@ -8,14 +9,21 @@ env.resources.nginx.conf_group = 'root'
 env.resources.nginx.www_root = '/var/www'
 env.resources.nginx.www_user = 'www-data'
 env.resources.nginx.www_group = 'www-data'
+env.resources.nginx.reload_command = 'nginx -t && service nginx reload'
 
 env.resources.nginx.site.conf_dir = '/etc/nginx/sites-available'
 env.resources.nginx.site.symlink_dir = '/etc/nginx/sites-enabled'
 env.resources.nginx.site.static_dirs = []
 env.resources.nginx.site.internal_static_dirs = []
+env.resources.nginx.site.notifies = ['nginx']
+
+@handler('nginx')
+def reload_nginx():
+    sudo(env.resources.nginx.reload_command)
 
 class Site(fs.File):
     template = 'site.conf'
+    incremental = False
 
     domain = None
     root = None
@@ -42,6 +50,14 @@ class Site(fs.File):
             self.www_root = env.resources.nginx.www_root
         self.require('www_root', 'name')
 
+    def dependencies(self):
+        deps = super(Site, self).dependencies()
+        for path in (env.resources.nginx.conf_dir, self.www_root,
+                self.symlink_dir, self.root):
+            if path:
+                deps.append(('path', '/{}'.format(path.strip('/'))))
+        return deps
+
     def ensure(self):
         nginx_conf_dir = fs.Directory(env.resources.nginx.conf_dir,
                                       owner=env.resources.nginx.conf_owner,
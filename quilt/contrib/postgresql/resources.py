@@ -1,41 +1,176 @@
+from collections import OrderedDict
+from contextlib import contextmanager
 from fabric.api import run, hide, settings, env
-from quilt.resources import Resource
+from quilt.resources import Resource, after_planning, before_run
 
 env.resources.postgresql.user.superuser = False
 env.resources.postgresql.user.createdb = False
 env.resources.postgresql.user.createrole = False
 env.resources.postgresql.privilege.with_grant_option = False
+# psql command, eg. to point quilt at a wrapper or a stand-in for testing
+env.resources.postgresql.psql = 'psql'
+
+# Catalog snapshots for the current run, keyed by host_string
+_catalogs = {}
+# Queued GRANT/REVOKE statements and batch nesting, keyed by host_string
+_statements = {}
+_batch_depth = {}
+
+# What ALL expands to for each kind of object whose ACLs are read
+PRIVILEGES = {
+    'DATABASE': ('CREATE', 'CONNECT', 'TEMPORARY'),
+    'SCHEMA': ('USAGE', 'CREATE'),
+    'TABLE': ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'TRUNCATE', 'REFERENCES',
+        'TRIGGER'),
+    'SEQUENCE': ('USAGE', 'SELECT', 'UPDATE'),
+}
+
+ACL_SQL = ("SELECT 'a', object, coalesce(r.rolname::text, 'PUBLIC'), "
+        "privilege_type::text, is_grantable::int::text FROM (SELECT {0} AS "
+        "object, (aclexplode({1})).* FROM {2}) a LEFT JOIN pg_roles r "
+        "ON r.oid = a.grantee")
+
+CATALOG_SQL = ' UNION ALL '.join([
+    "SELECT 'd', datname::text, pg_get_userbyid(datdba)::text, '', '' "
+        "FROM pg_database",
+    "SELECT 'r', rolname::text, rolsuper::int::text, rolcreatedb::int::text, "
+        "rolcreaterole::int::text FROM pg_roles",
+    ACL_SQL.format("'DATABASE ' || datname::text", 'datacl', 'pg_database'),
+    ACL_SQL.format("'SCHEMA ' || nspname::text", 'nspacl', 'pg_namespace'),
+    ACL_SQL.format("CASE relkind WHEN 'S' THEN 'SEQUENCE ' ELSE 'TABLE ' END "
+        "|| nspname::text || '.' || relname::text", 'relacl',
+        'pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace'),
+])
+
+def get_catalog():
+    """
+    Returns a snapshot of the current host's databases and roles, loaded with
+    a single query the first time a run needs it. Resources keep it up to date
+    as they create and drop objects.
+    """
+    if env.host_string not in _catalogs:
+        cmd = '{} template1 --tuples-only --no-align -c "{}"'.format(
+                env.resources.postgresql.psql, CATALOG_SQL)
+        with settings(hide('running', 'stdout')):
+            output = run(cmd)
+        _catalogs[env.host_string] = parse_catalog(output)
+    return _catalogs[env.host_string]
+
+def parse_catalog(output):
+    """
+    Parses the output of CATALOG_SQL into a dict with 'databases' (name ->
+    owner), 'roles' (name -> dict of superuser/createdb/createrole flags) and
+    'acls' (object, eg. 'TABLE public.foo' -> role -> privilege -> whether it
+    is grantable).
+    """
+    catalog = {'databases': {}, 'roles': {}, 'acls': {}}
+    for line in output.splitlines():
+        fields = line.strip().split('|')
+        if len(fields) != 5:
+            continue
+        kind, name = fields[:2]
+        if kind == 'd':
+            catalog['databases'][name] = fields[2]
+        elif kind == 'r':
+            catalog['roles'][name] = {
+                'superuser': fields[2] == '1',
+                'createdb': fields[3] == '1',
+                'createrole': fields[4] == '1',
+            }
+        elif kind == 'a':
+            grants = catalog['acls'].setdefault(name, {}).setdefault(fields[2], {})
+            grants[fields[3]] = fields[4] == '1'
+    return catalog
+
+def invalidate_catalog():
+    """
+    Discards the current host's catalog snapshot, eg. after changing it
+    outside of quilt's resources.
+    """
+    _catalogs.pop(env.host_string, None)
+
+@contextmanager
+def batch():
+    """
+    Context manager which queues GRANT/REVOKE statements for the current host
+    and runs them on exit, merging statements for the same object and user.
+    """
+    host = env.host_string
+    _batch_depth[host] = _batch_depth.get(host, 0) + 1
+    try:
+        yield
+    finally:
+        _batch_depth[host] -= 1
+        if not _batch_depth[host]:
+            flush()
+
+@before_run
+@after_planning
+def forget_catalog(host):
+    # the host may have changed since the last run, and the catalog was
+    # updated with planned changes that were never made
+    _catalogs.pop(host, None)
+
+def queue_statement(verb, privileges, object, user, with_grant_option=False):
+    statements = _statements.setdefault(env.host_string, OrderedDict())
+    key = (verb, object, user, bool(with_grant_option))
+    for privilege in privileges.split(','):
+        privilege = privilege.strip()
+        if privilege not in statements.setdefault(key, []):
+            statements[key].append(privilege)
+    if not _batch_depth.get(env.host_string):
+        flush()
+
+def flush():
+    """
+    Runs the queued GRANT/REVOKE statements for the current host.
+    """
+    statements = _statements.pop(env.host_string, {})
+    for (verb, object, user, with_grant_option), privileges in statements.items():
+        direction = verb == 'GRANT' and 'TO' or 'FROM'
+        sql = '{} {} ON {} {} "{}"'.format(verb, ', '.join(privileges), object,
+                direction, user)
+        if with_grant_option:
+            sql = "{} WITH GRANT OPTION".format(sql)
+        SqlMixin().run_sql(sql)
 
 class SqlMixin(object):
     def run_sql(self, sql):
         sql = sql.replace('"', '\\\\"')
-        runcmd = 'psql template1 -c "{};"'.format(sql)
+        runcmd = '{} template1 -c "{};"'.format(env.resources.postgresql.psql, sql)
         run(runcmd)
 
+    def apply_change(self, change):
+        if change['action'] == 'sql':
+            return self.run_sql(change['sql'])
+        return super(SqlMixin, self).apply_change(change)
+
 class Database(Resource):
     owner = None
 
+    def dependencies(self):
+        deps = super(Database, self).dependencies()
+        if self.owner:
+            deps.append('postgresql.user[{}]'.format(self.owner))
+        return deps
+
     def ensure(self):
         if not self.owner:
             self.owner = 'postgres'
         if not self.exists():
             self.log('Creating postgresql database {}'.format(self.name))
-            if not env.dry_run:
-                run('createdb -O {} {}'.format(self.owner, self.name))
-            else:
-                self._dummy_exists = True
+            self.change({'action': 'run',
+                'command': 'createdb -O {} {}'.format(self.owner, self.name)})
+            get_catalog()['databases'][self.name] = self.owner
     
     def remove(self):
         if self.exists():
             self.log('Dropping postgresql database {}'.format(self.name))
-            if not env.dry_run:
-                run('dropdb {}'.format(self.name))
+            self.change({'action': 'run', 'command': 'dropdb {}'.format(self.name)})
+            get_catalog()['databases'].pop(self.name, None)
 
     def exists(self):
-        cmd = "psql template1 -ltA | grep '^{}|'".format(self.name)
-        with settings(hide('running','warnings'), warn_only=True):
-            exists = run('[ "$({})" ]'.format(cmd))
-        return exists.return_code == 0 or self._dummy_exists
+        return self.name in get_catalog()['databases']
 
 class User(SqlMixin, Resource):
     password = None
@@ -47,12 +182,20 @@ class User(SqlMixin, Resource):
         if not self.exists():
             self.log('Creating postgresql user {}'.format(self.name))
             cmd = 'createuser --no-superuser --no-createdb --no-createrole {}'.format(self.name)
-            if not env.dry_run:
-                run(cmd)
-            else:
-                self._dummy_exists = True
+            self.change({'action': 'run', 'command': cmd})
+            get_catalog()['roles'][self.name] = {
+                'superuser': False, 'createdb': False, 'createrole': False}
        
         # ensure user attributes, such as password and permissions
+        wanted = {
+            'superuser': bool(self.superuser),
+            'createdb': bool(self.createdb),
+            'createrole': bool(self.createrole),
+        }
+        # passwords can't be compared, so they are always set
+        if not self.password and get_catalog()['roles'].get(self.name) == wanted:
+            return
+
         attrs = []
         if self.password:
             attrs.append("UNENCRYPTED PASSWORD '{}'".format(self.password))
@@ -62,42 +205,124 @@ class User(SqlMixin, Resource):
         
         self.log('Ensuring postgresql user attributes for {}'.format(self.name))
         sql = 'ALTER USER "{}" WITH {}'.format(self.name, ' '.join(attrs))
-        if not env.dry_run:
-            self.run_sql(sql)
+        self.change({'action': 'sql', 'sql': sql})
+        get_catalog()['roles'][self.name] = wanted
 
     def remove(self):
         self.log('Dropping postgresql user {}'.format(self.name))
-        if not env.dry_run:
-            run('dropuser {}'.format(self.name))
+        self.change({'action': 'run', 'command': 'dropuser {}'.format(self.name)})
+        get_catalog()['roles'].pop(self.name, None)
 
     def exists(self):
-        cmd1 = "psql template1 --tuples-only -c 'SELECT rolname FROM pg_catalog.pg_roles'"
-        cmd2 = "grep '^ {}$'".format(self.name)
-        with settings(hide('running','warnings'), warn_only=True):
-            exists = run('[ "$({} | {})" ]'.format(cmd1,cmd2))
-        return exists.return_code == 0 or self._dummy_exists
+        return self.name in get_catalog()['roles']
 
 class Privilege(SqlMixin, Resource):
     user = None
     object = None
     with_grant_option = None
 
+    @classmethod
+    def batch(cls):
+        return batch()
+
+    def dependencies(self):
+        deps = super(Privilege, self).dependencies()
+        deps.append('postgresql.user[{}]'.format(self.user))
+        if self.get_database():
+            deps.append('postgresql.database[{}]'.format(self.get_database()))
+        return deps
+
+    def get_database(self):
+        """
+        Returns the database name if the object is a database, otherwise None.
+        """
+        words = (self.object or '').split()
+        if len(words) == 2 and words[0].upper() == 'DATABASE':
+            return words[1].strip('"')
+
+    def get_acl_object(self):
+        """
+        Returns the object as the catalog's ACLs name it, eg. 'TABLE
+        public.foo', or None if its ACLs are not read.
+        """
+        words = (self.object or '').split()
+        if len(words) != 2 or words[0].upper() not in PRIVILEGES:
+            return None
+        kind = words[0].upper()
+        # unquoted identifiers are folded to lower case, and tables and
+        # sequences are assumed to be in the default search_path
+        parts = [p.startswith('"') and p.strip('"') or p.lower()
+                for p in words[1].split('.')]
+        if kind in ('TABLE', 'SEQUENCE') and len(parts) == 1:
+            parts.insert(0, 'public')
+        return '{} {}'.format(kind, '.'.join(parts))
+
+    def get_privileges(self):
+        names = [n.strip().upper() for n in self.name.split(',')]
+        if names in (['ALL'], ['ALL PRIVILEGES']):
+            return list(PRIVILEGES[self.get_acl_object().split()[0]])
+        return [n == 'TEMP' and 'TEMPORARY' or n for n in names]
+
+    def get_current(self):
+        """
+        Returns the privileges the user currently holds on the object, as a
+        dict of privilege -> whether it is grantable.
+        """
+        acls = get_catalog()['acls'].setdefault(self.get_acl_object(), {})
+        return acls.setdefault(self.user, {})
+
     def ensure(self):
-        # The simplest way to "ensure" the given privilege is to first revoke, then grant
-        self.remove()
+        if not self.get_acl_object():
+            # the ACLs of other objects (eg. functions) are not read from
+            # the catalog, so the privilege is reset by revoking, then
+            # granting it
+            self.remove()
+            self.log('Granting postgresql privileges for {}'.format(self.user))
+            self.grant('GRANT', self.name, self.with_grant_option)
+            return
 
-        sql = 'GRANT {} ON {} TO "{}"'.format(self.name, self.object, self.user)
-        if self.with_grant_option:
-            sql = "{} WITH GRANT OPTION".format(sql)
-        self.log('Granting postgresql privileges for {}'.format(self.user))
-        if not env.dry_run:
-            self.run_sql(sql)
+        current = self.get_current()
+        grant = [p for p in self.get_privileges()
+                if p not in current or (self.with_grant_option and not current[p])]
+        revoke_option = [p for p in self.get_privileges()
+                if not self.with_grant_option and current.get(p)]
+
+        if grant:
+            self.log('Granting postgresql privileges {} on {} for {}'.format(
+                    ', '.join(grant), self.object, self.user))
+            self.grant('GRANT', ', '.join(grant), self.with_grant_option)
+            for p in grant:
+                current[p] = bool(self.with_grant_option)
+        if revoke_option:
+            self.log('Revoking grant option for postgresql privileges {} on {} for {}'.format(
+                    ', '.join(revoke_option), self.object, self.user))
+            self.grant('REVOKE GRANT OPTION FOR', ', '.join(revoke_option))
+            for p in revoke_option:
+                current[p] = False
 
     def remove(self):
         self.log('Revoking postgresql privileges for {}'.format(self.user))
-        sql = 'REVOKE {} ON {} FROM "{}"'.format(self.name, self.object, self.user)
-        if not env.dry_run:
-            self.run_sql(sql)
+        self.grant('REVOKE', self.name)
+        if self.get_acl_object():
+            current = self.get_current()
+            for p in self.get_privileges():
+                current.pop(p, None)
+
+    def grant(self, verb, privileges, with_grant_option=False):
+        self.change({'action': 'grant', 'verb': verb, 'privileges': privileges,
+            'with_grant_option': bool(with_grant_option)})
+
+    def apply_change(self, change):
+        if change['action'] == 'grant':
+            return queue_statement(change['verb'], change['privileges'],
+                    self.object, self.user, change['with_grant_option'])
+        return super(Privilege, self).apply_change(change)
 
     def exists(self):
-        return False
+        if not self.get_acl_object():
+            return False
+        current = self.get_current()
+        for p in self.get_privileges():
+            if p not in current or current[p] != bool(self.with_grant_option):
+                return False
+        return True
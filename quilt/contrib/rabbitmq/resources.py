@@ -1,78 +1,194 @@
-from quilt.resources import Resource
+from quilt.resources import Resource, after_planning, before_run
 from fabric.api import sudo, hide, settings, env
 
 env.resources.rabbitmq.userpermission.configure = '.*'
 env.resources.rabbitmq.userpermission.read = '.*'
 env.resources.rabbitmq.userpermission.write = '.*'
+# rabbitmqctl command, eg. to point quilt at a stand-in for testing
+env.resources.rabbitmq.rabbitmqctl = 'rabbitmqctl'
 
-class User(Resource):
+# Broker state snapshots for the current run, keyed by host_string
+_snapshots = {}
+
+SNAPSHOT_ERL = ' '.join([
+    '[io:format("user\\t~s~n", [proplists:get_value(user, U)])',
+    '|| U <- rabbit_auth_backend_internal:list_users()],',
+    '[io:format("vhost\\t~s~n", [V]) || V <- rabbit_vhost:list()],',
+    '[io:format("permission\\t~s\\t~s\\t~s\\t~s\\t~s~n",',
+    '[proplists:get_value(K, P) || K <- [user, vhost, configure, read, write]])',
+    '|| P <- rabbit_auth_backend_internal:list_permissions()],',
+    '{}',
+    'ok.',
+])
+
+PASSWORD_ERL = ' '.join([
+    '[io:format("password\\t~s\\t~s~n", [U,',
+    'case rabbit_access_control:check_user_pass_login(list_to_binary(U),',
+    'list_to_binary(P)) of {{ok, _}} -> ok; _ -> refused end])',
+    '|| {{U, P}} <- [{}]],',
+])
+
+def erlang_string(value):
+    return '"{}"'.format(value.replace('\\', '\\\\').replace('"', '\\"'))
+
+def rabbitmqctl_command(args):
+    return '{} {}'.format(env.resources.rabbitmq.rabbitmqctl, args)
+
+def rabbitmqctl(args):
+    return sudo(rabbitmqctl_command(args))
+
+def rabbitmqctl_eval(expression):
+    expression = expression.replace("'", "'\\''")
+    with settings(hide('running', 'stdout')):
+        return rabbitmqctl("eval '{}'".format(expression))
+
+def password_checks(passwords):
+    """
+    Returns the erlang expression checking the given (user, password) pairs.
+    """
+    if not passwords:
+        return ''
+    pairs = ['{{{}, {}}}'.format(erlang_string(u), erlang_string(p))
+            for u, p in passwords]
+    return PASSWORD_ERL.format(', '.join(pairs))
+
+def get_snapshot(passwords=()):
+    """
+    Returns a snapshot of the current host's users, vhosts and permissions,
+    taken with a single `rabbitmqctl eval` the first time a run needs it. The
+    given (user, password) pairs are checked in the same call.
+    """
+    if env.host_string not in _snapshots:
+        output = rabbitmqctl_eval(SNAPSHOT_ERL.format(password_checks(passwords)))
+        _snapshots[env.host_string] = parse_snapshot(output)
+    return _snapshots[env.host_string]
+
+def check_passwords(passwords):
+    """
+    Checks (user, password) pairs against the broker, recording the results
+    in the current host's snapshot.
+    """
+    output = rabbitmqctl_eval('{} ok.'.format(password_checks(passwords)))
+    get_snapshot()['passwords'].update(parse_snapshot(output)['passwords'])
+
+def parse_snapshot(output):
+    """
+    Parses the output of SNAPSHOT_ERL into a dict with 'users' and 'vhosts'
+    sets, 'permissions' ((user, vhost) -> (configure, read, write)) and
+    'passwords' (user -> whether the checked password was accepted).
+    """
+    snapshot = {'users': set(), 'vhosts': set(), 'permissions': {},
+            'passwords': {}}
+    for line in output.splitlines():
+        fields = line.rstrip('\r').split('\t')
+        if fields[0] == 'user' and len(fields) == 2:
+            snapshot['users'].add(fields[1])
+        elif fields[0] == 'vhost' and len(fields) == 2:
+            snapshot['vhosts'].add(fields[1])
+        elif fields[0] == 'permission' and len(fields) == 6:
+            snapshot['permissions'][(fields[1], fields[2])] = tuple(fields[3:])
+        elif fields[0] == 'password' and len(fields) == 3:
+            snapshot['passwords'][fields[1]] = fields[2] == 'ok'
+    return snapshot
+
+def invalidate_snapshot():
+    """
+    Discards the current host's snapshot, eg. after changing the broker
+    outside of quilt's resources.
+    """
+    _snapshots.pop(env.host_string, None)
+
+@before_run
+@after_planning
+def forget_snapshot(host):
+    # the broker may have changed since the last run, and the snapshot was
+    # updated with planned changes that were never made
+    _snapshots.pop(host, None)
+
+class RabbitmqMixin(object):
+    def rabbitmqctl(self, args):
+        self.change({'action': 'sudo', 'command': rabbitmqctl_command(args)})
+
+
+class User(RabbitmqMixin, Resource):
     password = None
+
+    @classmethod
+    def prefetch(cls, resources):
+        passwords = [(r.name, r.password) for r in resources if r.password]
+        get_snapshot(passwords)
+
     def ensure(self):
+        snapshot = get_snapshot()
         if not self.exists():
             self.log('Adding rabbitmq user {}'.format(self.name))
-            if not env.dry_run:
-                sudo('rabbitmqctl add_user {} {}'.format(self.name, self.password))
-            else:
-                self._dummy_exists = True
-        else:
-            # ensure password
-            self.log('Ensuring password for rabbitmq user {}'.format(self.name))
-            if not env.dry_run:
-                sudo('rabbitmqctl change_password {} {}'.format(self.name, self.password))
-            else:
-                self._dummy_exists = True
+            self.rabbitmqctl('add_user {} {}'.format(self.name, self.password))
+            snapshot['users'].add(self.name)
+            snapshot['passwords'][self.name] = True
+            return
+
+        if not self.password or self.name not in snapshot['users']:
+            return
+        if self.name not in snapshot['passwords']:
+            check_passwords([(self.name, self.password)])
+        if not snapshot['passwords'][self.name]:
+            self.log('Changing password for rabbitmq user {}'.format(self.name))
+            self.rabbitmqctl('change_password {} {}'.format(self.name, self.password))
+            snapshot['passwords'][self.name] = True
 
     def remove(self):
-        if not self.exists():
+        if self.exists():
             self.log('Removing rabbitmq user {}'.format(self.name))
-            if not env.dry_run:
-                sudo('rabbitmqctl delete_user {}'.format(self.name, self.password))
+            self.rabbitmqctl('delete_user {}'.format(self.name))
+            get_snapshot()['users'].discard(self.name)
 
     def exists(self):
-        cmd  = "rabbitmqctl list_users | grep '^{}$'".format(self.name)
-        with settings(hide('running', 'warnings'), warn_only=True):
-            exists = sudo('[ "$({})" ]'.format(cmd))
-        return exists.returncode == 0 or self._dummy_exists
+        return self.name in get_snapshot()['users']
 
 
-class Vhost(Resource):
+class Vhost(RabbitmqMixin, Resource):
     def ensure(self):
         if not self.exists():
             self.log('Adding rabbitmq vhost {}'.format(self.name))
-            if not env.dry_run:
-                sudo('rabbitmqctl add_vhost {}'.format(self.name))
-            else:
-                self._dummy_exists = True
+            self.rabbitmqctl('add_vhost {}'.format(self.name))
+            get_snapshot()['vhosts'].add(self.name)
 
     def remove(self):
-        if not self.exists():
+        if self.exists():
             self.log('Removing rabbitmq vhost {}'.format(self.name))
-            if not env.dry_run:
-                sudo('rabbitmqctl delete_vhost {}'.format(self.name))
+            self.rabbitmqctl('delete_vhost {}'.format(self.name))
+            get_snapshot()['vhosts'].discard(self.name)
 
     def exists(self):
-        cmd  = "rabbitmqctl list_vhosts | grep '^{}$'".format(self.name)
-        with settings(hide('running', 'warnings'), warn_only=True):
-            exists = sudo('[ "$({})" ]'.format(cmd))
-        return exists.returncode == 0 or self._dummy_exists
+        return self.name in get_snapshot()['vhosts']
 
-class UserPermission(Resource):
+class UserPermission(RabbitmqMixin, Resource):
     user = None
     vhost = None
     configure = None
     read = None
     write = None
 
+    def dependencies(self):
+        deps = super(UserPermission, self).dependencies()
+        deps.append('rabbitmq.user[{}]'.format(self.user))
+        deps.append('rabbitmq.vhost[{}]'.format(self.vhost))
+        return deps
+
     def ensure(self):
+        if self.exists():
+            return
         self.log('Ensuring rabbitmq permissions for {}@{}'.format(self.user, self.vhost))
-        if not env.dry_run:
-            sudo('rabbitmqctl set_permissions -p {} {} "{}" "{}" "{}"'.format(
-                    self.vhost, self.user, self.configure, self.read, self.write))
+        self.rabbitmqctl('set_permissions -p {} {} "{}" "{}" "{}"'.format(
+                self.vhost, self.user, self.configure, self.read, self.write))
+        get_snapshot()['permissions'][(self.user, self.vhost)] = (
+                self.configure, self.read, self.write)
 
     def remove(self):
         self.log('Clearing rabbitmq permissions for {}@{}'.format(self.user, self.vhost))
-        if not env.dry_run:
-            sudo('rabbitmqctl clear_permissions -p {} {}'.format(self.vhost, self.user))
+        self.rabbitmqctl('clear_permissions -p {} {}'.format(self.vhost, self.user))
+        get_snapshot()['permissions'].pop((self.user, self.vhost), None)
 
     def exists(self):
-        return False
+        current = get_snapshot()['permissions'].get((self.user, self.vhost))
+        return current == (self.configure, self.read, self.write)
@@ -1,9 +1,11 @@
 import os
-from fabric.api import env
+from fabric.api import env, sudo
 from quilt.contrib import fs
+from quilt.resources import handler
 from quilt.utils import DefaultAttributeDict
 
 env.resources.supervisor.conf_dir = '/etc/supervisor/conf.d'
+env.resources.supervisor.update_command = 'supervisorctl reread && supervisorctl update'
 
 env.resources.supervisor.program = DefaultAttributeDict({
     'owner': 'root',
@@ -22,8 +24,14 @@ env.resources.supervisor.program = DefaultAttributeDict({
     'stderr_logfile_maxsize': '250MB',
     'stderr_logfile_keep': 10,
     'redirect_stderr': 'false',
-    'autostart': 'false'
+    'autostart': 'false',
+    'notifies': ['supervisor'],
 })
+env.resources.supervisor.group.notifies = ['supervisor']
+
+@handler('supervisor')
+def update_supervisor():
+    sudo(env.resources.supervisor.update_command)
 
 class SupervisorConf(fs.File):
     conf_dir = None
@@ -72,6 +80,7 @@ class Program(SupervisorConf):
     autostart = None
 
     template = 'program.conf'
+    incremental = False
 
     def clean(self):
         self.require('command')
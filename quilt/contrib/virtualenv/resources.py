@@ -1,12 +1,51 @@
+import os
+import re
+import hashlib
 from quilt.contrib import fs
+from quilt.resources import simulating
 from fabric.api import run, env, settings, abort, hide
 
 env.resources.virtualenv.virtualenv.system_site_packages = False
+# Remote directory of wheels shared by the virtualenvs on a host (pip builds
+# each requirement once, then installs from it), and a local directory of
+# wheels to push to it
+env.resources.virtualenv.virtualenv.wheelhouse = None
+env.resources.virtualenv.virtualenv.wheelhouse_source = None
+
+# Output of `virtualenv --version`, keyed by host_string
+_versions = {}
+
+# Records the requirements installed, and the interpreter they were installed
+# for, inside each virtualenv
+STAMP = '.quilt-requirements'
+
+def virtualenv_version():
+    """
+    Returns the version of virtualenv on the current host, as a tuple of
+    ints.
+    """
+    host = env.host_string
+    if host not in _versions:
+        with hide('stdout'):
+            _versions[host] = run('virtualenv --version')
+    return tuple(int(n) for n in re.findall(r'\d+', _versions[host])[:2])
 
 class VirtualEnv(fs.Directory):
     python = None
     system_site_packages = None
-    
+    # a local requirements file, or a list of requirements
+    requirements = None
+    wheelhouse = None
+    wheelhouse_source = None
+    incremental = False
+    # runs commands with changed Fabric settings
+    threadsafe = False
+
+    def fact_paths(self):
+        paths = super(VirtualEnv, self).fact_paths()
+        return paths + [os.path.join(self.path, 'bin/python'),
+                os.path.join(self.path, STAMP)]
+
     def ensure(self):
         parent = fs.Directory(self.path.rsplit('/', 1)[0])
         parent.ensure()
@@ -16,15 +55,11 @@ class VirtualEnv(fs.Directory):
         if not self.exists():
             if not self.python:
                 self.python = '`which python`'
-            
+
             self.log('Creating virtualenv at {}'.format(self.path))
 
-            # Get virtualenv version
-            with hide('stdout'):
-                version = run('virtualenv --version')
-            version = version.split('.')
             venv_args = ''
-            if version < (1,7):
+            if virtualenv_version() < (1,7):
                 if not self.system_site_packages:
                     venv_args = ' --no-site-packages'
             else:
@@ -32,11 +67,86 @@ class VirtualEnv(fs.Directory):
                         self.system_site_packages and 'system' or 'no')
 
             cmd = 'virtualenv{} -p {} {}'.format(venv_args, self.python, self.path)
-            if not env.dry_run:
-                output_ctrl = settings(hide('stdout'), warn_only=True)
-                with output_ctrl, parent.temp_ownership(recursive=True):
-                    result = run(cmd)
-                if result.return_code != 0:
-                    abort('Virtualenv creation failed:\n{}'.format(result))
+            with parent.temp_ownership(recursive=True):
+                self.change({'action': 'virtualenv', 'command': cmd})
+            if simulating():
+                fs.simulate({'op': 'mkdir', 'path': self.path, 'mode': self.mode})
 
         super(VirtualEnv, self).ensure()
+
+        if self.requirements:
+            self.install_requirements()
+
+    def get_requirements(self):
+        if isinstance(self.requirements, basestring):
+            with open(os.path.expanduser(self.requirements)) as f:
+                return f.read()
+        return ''.join('{}\n'.format(r) for r in self.requirements)
+
+    def requirements_stamp(self, requirements):
+        """
+        Returns what the stamp file holds once `requirements` are installed
+        with the virtualenv's current interpreter.
+        """
+        python = self.get_facts('bin/python')
+        return hashlib.sha256('{}\n{}'.format(
+                hashlib.sha256(requirements).hexdigest(),
+                python['sha256'])).hexdigest()
+
+    def install_requirements(self):
+        """
+        Installs the requirements with pip, unless the stamp file shows they
+        were already installed with the same interpreter.
+        """
+        requirements = self.get_requirements()
+        stamp = self.get_facts(STAMP)
+        expected = hashlib.sha256(self.requirements_stamp(requirements))
+        if stamp['exists'] and stamp['sha256'] == expected.hexdigest():
+            return
+
+        wheelhouse = self.wheelhouse
+        if wheelhouse:
+            fs.Directory(wheelhouse, owner=env.user,
+                    source=self.wheelhouse_source).ensure()
+
+        self.log('Installing requirements into {}'.format(self.path))
+        path = os.path.join(self.path, 'requirements.txt')
+        self.apply({'op': 'write', 'path': path, 'content': requirements,
+                'mode': 0644, 'uid': self.get_uid(self.owner),
+                'gid': self.get_gid(self.group)})
+        pip = os.path.join(self.path, 'bin/pip')
+        if wheelhouse:
+            # wheels are only built for requirements the wheelhouse lacks
+            cmd = ('{0} wheel --wheel-dir {1} --find-links {1} -r {2} && '
+                    '{0} install --no-index --find-links {1} -r {2}').format(
+                    pip, wheelhouse, path)
+        else:
+            cmd = '{} install -r {}'.format(pip, path)
+        with self.temp_ownership(recursive=True):
+            self.change({'action': 'pip', 'command': cmd,
+                    'requirements': requirements})
+
+    def apply_change(self, change):
+        if change['action'] == 'virtualenv':
+            # virtualenv needs the directory changes made so far
+            fs.flush()
+            with settings(hide('stdout'), warn_only=True):
+                result = run(change['command'])
+            if result.return_code != 0:
+                abort('Virtualenv creation failed:\n{}'.format(result))
+            self.invalidate_facts()
+            return
+        if change['action'] == 'pip':
+            fs.flush()
+            with settings(hide('stdout'), warn_only=True):
+                result = run(change['command'])
+            if result.return_code != 0:
+                abort('Installing requirements failed:\n{}'.format(result))
+            # the stamp is only written once pip has succeeded
+            self.invalidate_facts()
+            self.apply({'op': 'write', 'path': os.path.join(self.path, STAMP),
+                    'content': self.requirements_stamp(change['requirements']),
+                    'mode': 0644, 'uid': self.get_uid(self.owner),
+                    'gid': self.get_gid(self.group)})
+            return
+        return super(VirtualEnv, self).apply_change(change)
@@ -0,0 +1,315 @@
+"""
+Timing and round-trip instrumentation for converging resources.
+
+Once enabled, quilt records a span for each resource ensured or removed, and
+for each remote call made while doing so: pushy requests, remote agent and
+remote_import calls, and Fabric's run, sudo and put. Spans carry their wall
+time and the number of round-trips and bytes they caused, including those of
+the spans nested in them, eg:
+
+    instrument.enable()
+    converge(resources, hosts)
+    instrument.write('summary.json', 'trace.json')
+
+The trace is in Chrome's trace event format, so it can be opened in
+chrome://tracing or Perfetto, with one process per host.
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from fabric.api import env
+
+# Completed spans, in the order they finished
+_events = []
+# Round-trips and bytes per host_string, including those made outside spans
+_totals = {}
+_lock = threading.Lock()
+# Open spans of the current thread, innermost last
+_local = threading.local()
+_enabled = False
+_installed = False
+
+COUNTERS = ('round_trips', 'bytes_sent', 'bytes_received')
+
+def enable():
+    """
+    Starts recording, installing the Fabric hooks the first time.
+    """
+    global _enabled
+    install()
+    _enabled = True
+
+def disable():
+    global _enabled
+    _enabled = False
+
+def enabled():
+    return _enabled
+
+def reset():
+    """
+    Discards everything recorded so far.
+    """
+    with _lock:
+        del _events[:]
+        _totals.clear()
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+@contextmanager
+def span(name, category, resource=None, host=None):
+    """
+    Records the wall time of the enclosed block, along with the round-trips
+    and bytes counted within it.
+    """
+    if not _enabled:
+        yield
+        return
+    record = {
+        'name': name,
+        'category': category,
+        'host': host or env.host_string,
+        'resource': resource,
+        'pid': os.getpid(),
+        'tid': threading.current_thread().ident,
+        'start': time.time(),
+        'round_trips': 0,
+        'bytes_sent': 0,
+        'bytes_received': 0,
+    }
+    stack = _stack()
+    if resource is None and stack:
+        record['resource'] = stack[-1]['resource']
+    stack.append(record)
+    try:
+        yield
+    finally:
+        record['duration'] = time.time() - record['start']
+        stack.pop()
+        if stack:
+            for counter in COUNTERS:
+                stack[-1][counter] += record[counter]
+        with _lock:
+            _events.append(record)
+
+def mark(name, category='log'):
+    """
+    Records an instantaneous event, eg. a resource's log message.
+    """
+    if not _enabled:
+        return
+    stack = _stack()
+    record = {
+        'name': name,
+        'category': category,
+        'host': env.host_string,
+        'resource': stack and stack[-1]['resource'] or None,
+        'pid': os.getpid(),
+        'tid': threading.current_thread().ident,
+        'start': time.time(),
+        'duration': None,
+    }
+    with _lock:
+        _events.append(record)
+
+def count(host=None, **counters):
+    """
+    Adds to the round-trip and byte counters of the innermost open span and of
+    the host.
+    """
+    if not _enabled:
+        return
+    stack = _stack()
+    if stack:
+        for counter, value in counters.iteritems():
+            stack[-1][counter] += value
+    host = host or env.host_string
+    with _lock:
+        totals = _totals.setdefault(host, dict.fromkeys(COUNTERS, 0))
+        for counter, value in counters.iteritems():
+            totals[counter] += value
+
+def watch_connection(conn, host):
+    """
+    Counts the requests and message bytes of a pushy connection to `host`.
+    """
+    remote = conn.remote
+    send_request = remote.send_request
+    def counted_send_request(message_type, args):
+        if not _enabled:
+            return send_request(message_type, args)
+        with span('pushy.{}'.format(message_type), 'remote'):
+            count(host, round_trips=1)
+            return send_request(message_type, args)
+    remote.send_request = counted_send_request
+
+    # the message streams are private to pushy's connection, so bytes are
+    # only counted where they can be found. Responses are often read by
+    # pushy's serving thread, outside any span, so they only count towards
+    # the host.
+    ostream = getattr(remote, '_BaseConnection__ostream', None)
+    istream = getattr(remote, '_BaseConnection__istream', None)
+    if ostream is not None:
+        send_message = ostream.send_message
+        def counted_send_message(m):
+            count(host, bytes_sent=len(m.payload))
+            return send_message(m)
+        ostream.send_message = counted_send_message
+    if istream is not None:
+        receive_message = istream.receive_message
+        def counted_receive_message():
+            m = receive_message()
+            count(host, bytes_received=len(m.payload))
+            return m
+        istream.receive_message = counted_receive_message
+
+def install():
+    """
+    Wraps the Fabric internals behind run, sudo and put, so that calls made
+    through any imported reference to them are recorded.
+    """
+    global _installed
+    if _installed:
+        return
+    _installed = True
+    from fabric import operations, sftp
+
+    run_command = operations._run_command
+    def _run_command(command, *args, **kwargs):
+        if not _enabled:
+            return run_command(command, *args, **kwargs)
+        name = kwargs.get('sudo') and 'sudo' or 'run'
+        with span(name, 'fabric'):
+            result = run_command(command, *args, **kwargs)
+            received = len(result) + len(getattr(result, 'stderr', '') or '')
+            count(round_trips=1, bytes_sent=len(command),
+                    bytes_received=received)
+        return result
+    operations._run_command = _run_command
+
+    sftp_put = sftp.SFTP.put
+    def put(self, local_path, remote_path, *args, **kwargs):
+        if not _enabled:
+            return sftp_put(self, local_path, remote_path, *args, **kwargs)
+        if isinstance(local_path, basestring):
+            size = os.path.getsize(local_path)
+        else:
+            position = local_path.tell()
+            local_path.seek(0, os.SEEK_END)
+            size = local_path.tell()
+            local_path.seek(position)
+        with span('put', 'fabric'):
+            count(round_trips=1, bytes_sent=size)
+            return sftp_put(self, local_path, remote_path, *args, **kwargs)
+    sftp.SFTP.put = put
+
+def export(host=None):
+    """
+    Returns what was recorded (for `host`, or all hosts) as plain data, eg. to
+    pass from a worker process to `merge`.
+    """
+    with _lock:
+        events = [e for e in _events if host is None or e['host'] == host]
+        totals = dict((h, dict(t)) for h, t in _totals.iteritems()
+                if host is None or h == host)
+    return {'events': events, 'totals': totals}
+
+def merge(data):
+    """
+    Adds data returned by `export` in another process to what was recorded
+    here.
+    """
+    with _lock:
+        _events.extend(data['events'])
+        for host, counters in data['totals'].iteritems():
+            totals = _totals.setdefault(host, dict.fromkeys(COUNTERS, 0))
+            for counter in COUNTERS:
+                totals[counter] += counters[counter]
+
+def summary(slowest=20):
+    """
+    Returns the recorded time, round-trips and bytes per host and per
+    resource, and the `slowest` resources overall. A host's `elapsed` time
+    covers whole collections, including prefetching and batched changes,
+    while its `time` only adds up the resources.
+    """
+    with _lock:
+        events = list(_events)
+        totals = dict((h, dict(t)) for h, t in _totals.iteritems())
+
+    hosts = {}
+    for host, counters in totals.iteritems():
+        hosts[host] = dict(counters, elapsed=0.0, time=0.0, resources={})
+    for event in events:
+        host = hosts.setdefault(event['host'], dict(dict.fromkeys(COUNTERS, 0),
+                elapsed=0.0, time=0.0, resources={}))
+        if event['category'] == 'collection':
+            host['elapsed'] += event['duration']
+        if event['category'] not in ('ensure', 'remove', 'apply'):
+            continue
+        resource = host['resources'].setdefault(event['resource'],
+                dict(dict.fromkeys(COUNTERS, 0), time=0.0))
+        resource['time'] += event['duration']
+        host['time'] += event['duration']
+        for counter in COUNTERS:
+            resource[counter] += event[counter]
+
+    ranked = []
+    for host, data in hosts.iteritems():
+        for key, resource in data['resources'].iteritems():
+            ranked.append({'host': host, 'resource': key,
+                'time': resource['time']})
+    ranked.sort(key=lambda r: r['time'], reverse=True)
+    return {'hosts': hosts, 'slowest': ranked[:slowest]}
+
+def chrome_trace():
+    """
+    Returns the recorded spans in Chrome's trace event format, with a process
+    per host and a thread per worker thread.
+    """
+    with _lock:
+        events = sorted(_events, key=lambda e: e['start'])
+    pids = {}
+    tids = {}
+    trace = []
+    for event in events:
+        if event['host'] not in pids:
+            pids[event['host']] = len(pids) + 1
+            trace.append({'ph': 'M', 'name': 'process_name',
+                'pid': pids[event['host']], 'tid': 0,
+                'args': {'name': event['host'] or 'local'}})
+        thread = (event['host'], event['pid'], event['tid'])
+        if thread not in tids:
+            tids[thread] = len(tids) + 1
+        item = {
+            'name': event['name'],
+            'cat': event['category'],
+            'pid': pids[event['host']],
+            'tid': tids[thread],
+            'ts': int(event['start'] * 1e6),
+            'args': {'resource': event['resource']},
+        }
+        if event['duration'] is None:
+            item.update(ph='i', s='t')
+        else:
+            item.update(ph='X', dur=int(event['duration'] * 1e6))
+            for counter in COUNTERS:
+                item['args'][counter] = event[counter]
+        trace.append(item)
+    return {'traceEvents': trace, 'displayTimeUnit': 'ms'}
+
+def write(summary_path=None, trace_path=None):
+    """
+    Writes the JSON summary and/or the Chrome trace to the given paths.
+    """
+    if summary_path:
+        with open(summary_path, 'w') as f:
+            json.dump(summary(), f, indent=2, sort_keys=True)
+    if trace_path:
+        with open(trace_path, 'w') as f:
+            json.dump(chrome_trace(), f)
@@ -1,28 +1,57 @@
-from fabric.state import env, default_channel
-from fabric.network import needs_host
+import atexit
+import inspect
+import marshal
+import threading
+import Queue
+from fabric import operations
+from fabric.state import env, output, connections as ssh_connections
+from fabric.network import needs_host, ssh
+from fabric.utils import error
 
 import pushy
 import pushy.transport
 from pushy.transport.ssh import WrappedChannelFile
+from quilt import instrument
+
+def open_channel(host_string):
+    """
+    Opens a session channel on Fabric's SSH connection to `host_string`. Like
+    fabric.state.default_channel, but usable from threads connecting to other
+    hosts than env.host_string.
+    """
+    try:
+        chan = ssh_connections[host_string].get_transport().open_session()
+    except ssh.SSHException, e:
+        if str(e) != 'SSH session not active':
+            raise
+        ssh_connections[host_string].close()
+        del ssh_connections[host_string]
+        chan = ssh_connections[host_string].get_transport().open_session()
+    chan.settimeout(0.1)
+    chan.input_enabled = True
+    return chan
 
 class FabricPopen(pushy.transport.BaseTransport):
     """
     Pushy transport for Fabric, piggy-backing the Paramiko SSH connection
-    managed by Fabric.
+    managed by Fabric. The address is the host_string to connect to.
     """
 
     def __init__(self, command, address):
         pushy.transport.BaseTransport.__init__(self, address)
+        self.__closed = True
 
-        # Join arguments into a string
+        # Join arguments into a string. The interpreter is left unquoted, so
+        # it may be a command line such as "sudo -n python".
         args = command
-        for i in range(len(args)):
+        for i in range(1, len(args)):
             if " " in args[i]:
                 args[i] = "'%s'" % args[i]
         command = " ".join(args)
 
-        self.__channel = default_channel()
+        self.__channel = open_channel(address or env.host_string)
         self.__channel.exec_command(command)
+        self.__closed = False
         self.stdin  = WrappedChannelFile(self.__channel.makefile("wb"), 1)
         self.stdout = WrappedChannelFile(self.__channel.makefile("rb"), 0)
         self.stderr = self.__channel.makefile_stderr("rb")
@@ -31,6 +60,9 @@ class FabricPopen(pushy.transport.BaseTransport):
         self.close()
 
     def close(self):
+        if self.__closed:
+            return
+        self.__closed = True
         if hasattr(self, "stdin"):
             self.stdin.close()
             self.stdout.close()
@@ -45,23 +77,304 @@ pushy.transports["fabric"] = pseudo_module
 
 ###############################################################################
 
+# Pushy target for new connections, eg. "local:" for the benchmark harness.
+# The host_string is appended when it ends with a colon.
+env.pushy_transport = "fabric:"
+# Run shell commands over the host's pushy connection, when there is one,
+# rather than opening an SSH channel for each. This applies to every run and
+# sudo in the process, and such commands get no terminal or input, and their
+# output is only shown once they finish, so it is off by default.
+env.pushy_shell = False
+# Command prefix for the privileged session's interpreter (see
+# privileged_agent), or None to always fall back to Fabric's sudo. It must
+# not prompt for a password.
+env.pushy_sudo = "sudo -n"
+
 # Pushy connection cache
 connections = {}
 
+# Remote agent cache
+agents = {}
+
+# Guards both caches when resources are ensured from several threads
+_lock = threading.RLock()
+# Serializes connecting to each (host_string, python), while other hosts
+# connect concurrently
+_connect_locks = {}
+# Hosts a privileged session could not be opened on
+_privileged_failed = set()
+
+def _connect_lock(key):
+    with _lock:
+        return _connect_locks.setdefault(key, threading.RLock())
+
+def reset():
+    """
+    Forgets all pushy connections and agents without closing them. Used by
+    worker processes, which must not share the parent's SSH channels.
+    """
+    connections.clear()
+    agents.clear()
+    _privileged_failed.clear()
+
+def close_all():
+    """
+    Closes every pushy connection. Called at exit, so that channels are not
+    left to be closed by the garbage collector.
+    """
+    with _lock:
+        items = connections.items()
+        reset()
+    for key, conn in items:
+        try:
+            conn.close()
+        except Exception:
+            pass
+atexit.register(close_all)
+
+def alive(conn, host_string):
+    """
+    Returns whether a pushy connection can still be used, without a
+    round-trip.
+    """
+    if conn.server is None:
+        return False
+    thread = getattr(conn, "serve_thread", None)
+    if thread is not None and not thread.is_alive():
+        return False
+    if env.pushy_transport == "fabric:" and host_string in ssh_connections:
+        transport = ssh_connections[host_string].get_transport()
+        return transport is not None and transport.is_active()
+    return True
+
+def discard(host_string, python="python"):
+    """
+    Closes and forgets the connection to a host, eg. after it failed.
+    """
+    with _lock:
+        conn = connections.pop((host_string, python), None)
+        agents.pop((host_string, python), None)
+    if conn is not None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+def connect(host_string, python="python"):
+    """
+    Returns the pushy connection for `host_string`, connecting if there is
+    none yet or the previous one has died.
+    """
+    key = (host_string, python)
+    with _connect_lock(key):
+        conn = connections.get(key)
+        if conn is not None and not alive(conn, host_string):
+            discard(host_string, python)
+            conn = None
+        if conn is None:
+            target = env.pushy_transport
+            if target.endswith(":"):
+                target += host_string
+            with instrument.span("connect", "remote", host=host_string):
+                conn = pushy.connect(target, python=python)
+            instrument.watch_connection(conn, host_string)
+            with _lock:
+                connections[key] = conn
+    return conn
+
+@needs_host
+def get_connection(python="python"):
+    """
+    Returns the pushy connection for the current host, creating it if needed.
+    """
+    return connect(env.host_string, python)
+
 @needs_host
 def remote_import(name, python="python"):
     """
     A Fabric operation for importing and returning a reference to a remote
     Python package.
     """
-
-    if (env.host_string, python) in connections:
-        conn = connections[(env.host_string, python)]
-    else:
-        conn = pushy.connect("fabric:", python=python)
-        connections[(env.host_string, python)] = conn
-    m = getattr(conn.modules, name)
-    if "." in name:
-        for p in name.split(".")[1:]:
-            m = getattr(m, p)
+    conn = get_connection(python)
+    with instrument.span("remote_import %s" % name, "remote"):
+        m = getattr(conn.modules, name)
+        if "." in name:
+            for p in name.split(".")[1:]:
+                m = getattr(m, p)
     return m
+
+
+class RemoteAgent(object):
+    """
+    Local handle for the quilt agent running in a remote interpreter.
+
+    Attribute access returns a callable for the agent function of the same
+    name. Arguments and results are marshalled in both directions, so each
+    call is a single round-trip regardless of the size of its data.
+    """
+
+    def __init__(self, dispatch):
+        self._dispatch = dispatch
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        def call(*args):
+            with instrument.span("agent.%s" % name, "remote"):
+                return marshal.loads(self._dispatch(name, marshal.dumps(args)))
+        call.__name__ = name
+        return call
+
+def load_agent(host_string, python="python"):
+    """
+    Returns the L{RemoteAgent} for `host_string`, shipping the source of
+    L{quilt.agent} over its pushy connection the first time.
+    """
+    key = (host_string, python)
+    with _connect_lock(key):
+        conn = connect(host_string, python)
+        agent = agents.get(key)
+        if agent is None:
+            from quilt import agent as agent_module
+            namespace = conn.eval('{"__name__": "quilt_agent"}')
+            conn.execute(inspect.getsource(agent_module), namespace)
+            agent = agents[key] = RemoteAgent(namespace["dispatch"])
+    return agent
+
+@needs_host
+def remote_agent(python="python"):
+    """
+    A Fabric operation returning a L{RemoteAgent} for the current host.
+    """
+    return load_agent(env.host_string, python)
+
+def privileged_python(python="python"):
+    return "%s %s" % (env.pushy_sudo, python)
+
+@needs_host
+def privileged_agent(python="python"):
+    """
+    A Fabric operation returning a L{RemoteAgent} running as root on the
+    current host, over a second pushy connection whose interpreter is started
+    with env.pushy_sudo. Returns None if that is disabled or not permitted, so
+    that callers can fall back to sudo.
+    """
+    host = env.host_string
+    if not env.pushy_sudo or host in _privileged_failed:
+        return None
+    try:
+        return load_agent(host, privileged_python(python))
+    except Exception:
+        _privileged_failed.add(host)
+        discard(host, privileged_python(python))
+        return None
+
+def warm_up(hosts, python="python", pool_size=None):
+    """
+    Connects to each of `hosts` and ships the remote agent ahead of time,
+    several hosts at once (up to `pool_size`, default: all of them). Needs
+    non-interactive SSH authentication. Returns the hosts that failed.
+    """
+    jobs = Queue.Queue()
+    for host in hosts:
+        jobs.put(host)
+    failed = []
+
+    def work():
+        while True:
+            try:
+                host = jobs.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                load_agent(host, python)
+            except BaseException:
+                failed.append(host)
+
+    threads = [threading.Thread(target=work)
+            for i in range(min(pool_size or len(hosts), len(hosts)))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    return failed
+
+###############################################################################
+
+_fabric_run_command = operations._run_command
+
+def _run_command(command, shell=True, pty=True, combine_stderr=True,
+        sudo=False, user=None, quiet=False, warn_only=False, stdout=None,
+        stderr=None, group=None, timeout=None, shell_escape=None, **kwargs):
+    """
+    Stands in for Fabric's _run_command, behind run and sudo. If
+    env.pushy_shell is set, runs commands through the remote agent when the
+    host already has a pushy connection; sudo commands (as root) use the
+    privileged agent. Other users, agent forwarding, timeouts (including
+    env.command_timeout) and streamed output still go through Fabric.
+    """
+    agent = None
+    if (env.pushy_shell and not env.forward_agent and not stdout
+            and not stderr and not timeout and not env.command_timeout
+            and (env.host_string, "python") in connections):
+        if not sudo:
+            agent = remote_agent()
+        elif (user or env.sudo_user) in (None, "root") and not group:
+            agent = privileged_agent()
+    if agent is None:
+        return _fabric_run_command(command, shell=shell, pty=pty,
+                combine_stderr=combine_stderr, sudo=sudo, user=user,
+                quiet=quiet, warn_only=warn_only, stdout=stdout,
+                stderr=stderr, group=group, timeout=timeout,
+                shell_escape=shell_escape, **kwargs)
+    which = sudo and "sudo" or "run"
+
+    manager = operations._noop
+    if warn_only:
+        manager = operations.warn_only_manager
+    if quiet:
+        manager = operations.quiet_manager
+    with manager():
+        if shell_escape is None:
+            shell_escape = env.get("shell_escape", True)
+        wrapped_command = operations._shell_wrap(
+            operations._prefix_env_vars(
+                operations._prefix_commands(command, "remote")),
+            shell_escape, shell, None)
+        if output.debug:
+            print("[%s] %s: %s" % (env.host_string, which, wrapped_command))
+        elif output.running:
+            print("[%s] %s: %s" % (env.host_string, which, command))
+
+        if combine_stderr is None:
+            combine_stderr = env.combine_stderr
+        stdout, stderr, status = agent.shell(wrapped_command, combine_stderr)
+        for stream, lines in (("out", stdout), ("err", stderr)):
+            if getattr(output, "std" + stream) and lines:
+                for line in lines.splitlines():
+                    print("[%s] %s: %s" % (env.host_string, stream, line))
+
+        out = operations._AttributeString(stdout.strip())
+        err = operations._AttributeString(stderr.strip())
+        out.failed = False
+        out.command = command
+        out.real_command = wrapped_command
+        if status not in env.ok_ret_codes:
+            out.failed = True
+            msg = "%s() received nonzero return code %s while executing" % (
+                which, status
+            )
+            if env.warn_only:
+                msg += " '%s'!" % command
+            else:
+                msg += "!\n\nRequested: %s\nExecuted: %s" % (
+                    command, wrapped_command
+                )
+            error(message=msg, stdout=out, stderr=err)
+        out.return_code = status
+        out.succeeded = not out.failed
+        out.stderr = err
+        return out
+
+operations._run_command = _run_command
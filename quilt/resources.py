@@ -1,32 +1,64 @@
-import inspect
-from fabric.api import env, abort
-from quilt import utils
+import base64
+import contextlib
+import json
+import sys
+import time
+import threading
+import Queue
+from fabric.api import env, abort, execute, run, sudo, warn
+from fabric.decorators import parallel
+from quilt import utils, instrument
 
 env.resources = utils.DefaultAttributeDict()
 env.dry_run = False
+env.resource_workers = 1
+# Record where resources are defined, for abort messages
+env.resource_provenance = True
 _registry = {}
+# Remote module cache, keyed by (host_string, module)
 _remote_import_cache = {}
+# Plans being made, keyed by host_string
+_plans = {}
+# Functions called with the host_string after planning for it
+_planning_listeners = []
+# Functions called with the host_string when a run or plan on it starts
+_run_listeners = []
+# Default settings per resource class, with the env.resources version they
+# were compiled from
+_class_defaults_cache = {}
+# Notification handlers, as (name, function) in the order they were
+# registered
+_handlers = []
+# Names of the handlers notified during the current run, and the nesting of
+# runs, keyed by host_string
+_notified = {}
+_run_depth = {}
 
 class Resource(object):
     name = None
+    requires = None
+    # names of the handlers (see `handler`) to notify when this resource
+    # changes
+    notifies = None
+    # whether ensure may run in a worker thread alongside other resources
+    # (see `schedule`), which it must not do if it changes Fabric's env or
+    # module state shared between resources without locking
+    threadsafe = False
 
     def __init__(self, name, *args, **kwargs):
         module = self.__class__.__module__.split('.')[-2]
         rname = self.__class__.__name__.lower()
         
         caller = None
-        # get who defined us by finding the first non-__init__ frame
-        for frame in inspect.stack()[1:]:
-            if frame[3] == '__init__': 
-                continue
-            caller = frame
-            break
+        if env.resource_provenance:
+            caller = _caller()
 
         # Resources with same type/name must be uniquely defined
         key = '{}.{}[{}]'.format(module, rname, name)
-        if _registry.get(key):
-            self.__dict__ = _registry[key].__dict__
-            if (caller[1:2] not in [f[1:2] for f in self._defined_in]): 
+        existing = _registry.get(key)
+        if existing:
+            self.__dict__ = existing.__dict__
+            if caller and not any(f[0] == caller[0] for f in self._defined_in):
                 self._defined_in.append(caller)
             # apply kwarg attributes for undefined attributes
             for k,v in kwargs.iteritems():
@@ -34,26 +66,19 @@ class Resource(object):
                     setattr(self, k, v)
             return
         
-        self._defined_in = [caller]
+        self._defined_in = caller and [caller] or []
                     
         _registry[key] = self
         self.key = key
         
         self.module = module
         self.name = name
-        self._dummy_exists = False # used for dry_run
-
-        parents = [c for c in self.__class__.mro() if c not in Resource.mro()][1:]
-        parents.reverse()
 
         # Get initial state for first invocation
-        state = {}
-        for parent in parents:
-            parent_module = parent.__module__.split('.')[-2]
-            parent_rname = parent.__name__.lower()
-            state.update(env.resources[parent_module][parent_rname])
-        state.update(env.resources[self.module][rname])
-        state.update(env.resources[self.module][rname][name])
+        state = dict(_class_defaults(self.__class__))
+        named = _settings(module, rname).get(name)
+        if isinstance(named, dict):
+            state.update(named)
         state.update(kwargs)
 
         for k,v in state.iteritems():
@@ -61,10 +86,11 @@ class Resource(object):
     
     def abort(self, msg):
         from fabric import colors
-        help = '\n\n{}, defined in:\n'.format(self.key)
-        for frame in self._defined_in:
-            help += '  {1}:{2}\n'.format(*frame)
-        msg = colors.blue(help) + '\n' + msg
+        if self._defined_in:
+            help = '\n\n{}, defined in:\n'.format(self.key)
+            for filename, line in self._defined_in:
+                help += '  {}:{}\n'.format(filename, line)
+            msg = colors.blue(help) + '\n' + msg
         abort(msg)
 
     def require(self, *args):
@@ -83,19 +109,114 @@ class Resource(object):
     def exists(self):
         raise NotImplementedError
 
+    def provides(self):
+        """
+        Returns the tokens other resources may list in their dependencies to
+        refer to this resource.
+        """
+        return [self.key]
+
+    def dependencies(self):
+        """
+        Returns the resources (or tokens, see `provides`) this resource must be
+        ensured after. Includes anything listed in `requires`; subclasses
+        extend this with dependencies inferred from their settings.
+        """
+        deps = []
+        for dep in self.requires or []:
+            if isinstance(dep, Resource):
+                dep = dep.key
+            deps.append(dep)
+        return deps
+
+    @classmethod
+    def batch(cls):
+        """
+        Returns a context manager wrapped around ensuring a collection, within
+        which resources of this type may defer and combine remote changes.
+        """
+        return contextlib.nested()
+
+    @classmethod
+    def prefetch(cls, resources):
+        """
+        Gathers remote state for several resources at once, before they are
+        ensured. Called by ResourceCollection with every item that shares
+        this implementation.
+        """
+        pass
+
+    def change(self, change):
+        """
+        Makes a change to this resource. `change` is a dict of plain data with
+        an 'action' key, which `apply_change` knows how to carry out. While
+        planning, the change is added to the plan instead, and in a dry run it
+        is skipped.
+
+        Either way, resources then update whatever state they keep about the
+        host as if the change had been made, so later checks see it.
+        """
+        plan = _plans.get(env.host_string)
+        if plan is not None:
+            plan.add(self, change)
+        elif not env.dry_run:
+            self.apply_change(change)
+            self.notify()
+
+    def apply_change(self, change):
+        """
+        Carries out a change made with `change`. Subclasses handle their own
+        actions; the 'run' and 'sudo' actions run a shell command.
+        """
+        if change['action'] == 'run':
+            return run(change['command'])
+        if change['action'] == 'sudo':
+            return sudo(change['command'])
+        raise NotImplementedError(change['action'])
+
+    def dump_change(self, change):
+        """
+        Returns `change` as data that means the same in another process, for
+        saving it in a plan. Subclasses replace references to anything that
+        only exists in this one.
+        """
+        return change
+
+    def notify(self):
+        """
+        Notifies the handlers this resource `notifies` that it has changed.
+        """
+        for name in self.notifies or []:
+            notify(name)
+
     def remote_import(self, module):
-        from quilt.pushy_support import remote_import
-        if not _remote_import_cache.get(module):
-            _remote_import_cache[module] = remote_import(module)
-        return _remote_import_cache[module]
+        from quilt.pushy_support import get_connection, remote_import
+        key = (env.host_string, module)
+        conn = get_connection()
+        cached = _remote_import_cache.get(key)
+        # modules imported over a connection that has since been replaced
+        # are imported again
+        if not cached or cached[0] is not conn:
+            _remote_import_cache[key] = (conn, remote_import(module))
+        return _remote_import_cache[key][1]
 
     def log(self, msg):
         from fabric import colors
         line = ''
         if env.dry_run:
             line += colors.red('[DRY RUN] ')
+        elif env.host_string in _plans:
+            line += colors.red('[PLAN] ')
         line += colors.blue(msg)
         print line
+        instrument.mark(msg)
+
+    def call(self, method):
+        """
+        Calls `method` (eg. ensure or remove), recording it with quilt.instrument.
+        """
+        with instrument.span(self.key, method, self.key):
+            return getattr(self, method)()
 
     def clean(self):
         """
@@ -107,19 +228,121 @@ class Resource(object):
         return self.__class__.__name__
 
 
+def _settings(module, rname):
+    """
+    Returns the env.resources settings node for a resource type, without
+    creating empty nodes for types that have none.
+    """
+    node = env.resources.get(module)
+    if isinstance(node, dict):
+        node = node.get(rname)
+    if isinstance(node, dict):
+        return node
+    return {}
+
+def _class_defaults(cls):
+    """
+    Returns the default settings for resources of `cls`, merged from the
+    env.resources nodes of its resource classes, most derived last. They are
+    compiled once per class, and again after env.resources changes.
+    """
+    version = (id(env.resources), utils.settings_version())
+    cached = _class_defaults_cache.get(cls)
+    if cached is None or cached[0] != version:
+        defaults = {}
+        classes = [c for c in cls.mro() if c not in Resource.mro()]
+        classes.reverse()
+        for c in classes:
+            node = _settings(c.__module__.split('.')[-2], c.__name__.lower())
+            for k, v in node.iteritems():
+                # nested nodes hold settings for individually named resources
+                if not isinstance(v, utils.DefaultAttributeDict):
+                    defaults[k] = v
+        cached = _class_defaults_cache[cls] = (version, defaults)
+    return cached[1]
+
+def _caller():
+    """
+    Returns the (filename, line) a resource is being defined at: the first
+    frame above Resource.__init__ that is not itself an __init__ method.
+    """
+    # only raw frames are used, as inspect.stack() would read source lines
+    frame = sys._getframe(2)
+    while frame is not None and frame.f_code.co_name == '__init__':
+        frame = frame.f_back
+    if frame is not None:
+        return (frame.f_code.co_filename, frame.f_lineno)
+
+
 import collections
 class ResourceCollection(collections.Iterable):
     def __init__(self, *items):
         self._items = list(items)
         super(ResourceCollection, self).__init__()
 
-    def ensure(self):
+    def ensure(self, workers=None):
+        """
+        Ensures all resources, each after the resources it depends on. With
+        more than one worker (default: env.resource_workers), independent
+        threadsafe resources are ensured concurrently. In a dry run, this only
+        plans.
+        """
+        if env.dry_run:
+            self.plan(workers)
+            return
+        with instrument.span('ensure', 'collection'), notifications():
+            self.clean()
+            self.prefetch()
+            with self.batches():
+                schedule(list(self), lambda r: r.call('ensure'),
+                        workers or env.resource_workers)
+
+    def plan(self, workers=None):
+        """
+        Works out the changes `ensure` would make on the current host, without
+        making them, and returns them as a Plan.
+        """
+        plan = Plan(env.host_string)
+        with instrument.span('plan', 'collection'), planning(plan):
+            self.clean()
+            self.prefetch()
+            with self.batches():
+                schedule(list(self), lambda r: r.call('ensure'),
+                        workers or env.resource_workers)
+        return plan
+
+    def apply(self, plan):
+        """
+        Makes the changes in `plan`, without checking the resources again.
+        """
+        with instrument.span('apply', 'collection'), notifications():
+            with self.batches():
+                plan.apply()
+
+    def batches(self):
+        return contextlib.nested(*[type(items[0]).batch()
+                for items in self.implementations('batch')])
+
+    def prefetch(self):
+        for items in self.implementations('prefetch'):
+            name = '{}.prefetch'.format(type(items[0]).__name__)
+            with instrument.span(name, 'prefetch'):
+                type(items[0]).prefetch(items)
+
+    def implementations(self, method):
+        """
+        Groups items by the implementation of the given classmethod they use.
+        """
+        groups = collections.OrderedDict()
         for r in self:
-            r.ensure()
+            func = getattr(type(r), method).__func__
+            groups.setdefault(func, []).append(r)
+        return groups.values()
 
     def remove(self):
-        for r in self:
-            r.remove()
+        with instrument.span('remove', 'collection'):
+            for r in self:
+                r.call('remove')
 
     def clean(self):
         for r in self:
@@ -129,12 +352,354 @@ class ResourceCollection(collections.Iterable):
         self._items.append(item)
 
     def __iter__(self):
+        # resources with the same key share their state, so only yield the first
+        seen = set()
         for r in self._items:
             if isinstance(r, ResourceCollection):
-                for sub in r:
-                    yield sub
+                subs = r
             else:
-                yield r
+                subs = [r]
+            for sub in subs:
+                if sub.key not in seen:
+                    seen.add(sub.key)
+                    yield sub
 
     def __repr__(self):
         return 'ResourceCollection({})'.format(self._items)
+
+
+class Plan(object):
+    """
+    The changes to make to resources on one host, in the order to make them.
+    Each change is a dict of plain data, so a plan can be saved with `dumps`
+    and applied later.
+    """
+
+    def __init__(self, host_string=None, changes=None):
+        self.host_string = host_string
+        self.changes = changes or []
+        self._lock = threading.Lock()
+
+    def add(self, resource, change):
+        with self._lock:
+            self.changes.append(dict(change, resource=resource.key))
+
+    def resources(self):
+        """
+        Returns the keys of the resources with changes, in order.
+        """
+        keys = collections.OrderedDict()
+        for change in self.changes:
+            keys[change['resource']] = True
+        return keys.keys()
+
+    def apply(self):
+        for change in self.changes:
+            change = dict(change)
+            resource = _registry.get(change.pop('resource'))
+            if resource is None:
+                abort('Plan refers to an undefined resource')
+            with instrument.span(change['action'], 'apply', resource.key):
+                resource.apply_change(change)
+            resource.notify()
+
+    def dumps(self):
+        changes = []
+        for change in self.changes:
+            resource = _registry.get(change['resource'])
+            if resource is not None:
+                change = resource.dump_change(change)
+            changes.append(_encode_bytes(change))
+        return json.dumps({'host_string': self.host_string,
+                'changes': changes})
+
+    @classmethod
+    def loads(cls, data):
+        data = json.loads(data)
+        return cls(data['host_string'],
+                [_decode_bytes(c) for c in data['changes']])
+
+    def __len__(self):
+        return len(self.changes)
+
+    def __iter__(self):
+        return iter(self.changes)
+
+    def __repr__(self):
+        return 'Plan({}, {} changes)'.format(self.host_string, len(self))
+
+def _encode_bytes(value):
+    """
+    Returns `value` with the byte strings in it that are not ASCII (eg. file
+    content) replaced by {'__bytes__': base64}, as JSON only holds text.
+    """
+    if isinstance(value, dict):
+        return dict((k, _encode_bytes(v)) for k, v in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return [_encode_bytes(v) for v in value]
+    if isinstance(value, str):
+        try:
+            value.decode('ascii')
+        except UnicodeDecodeError:
+            return {'__bytes__': base64.b64encode(value)}
+    return value
+
+def _decode_bytes(value):
+    if isinstance(value, dict):
+        if value.keys() == ['__bytes__']:
+            return base64.b64decode(value['__bytes__'])
+        return dict((k, _decode_bytes(v)) for k, v in value.iteritems())
+    if isinstance(value, list):
+        return [_decode_bytes(v) for v in value]
+    return value
+
+@contextlib.contextmanager
+def planning(plan):
+    """
+    Context manager within which resources on the current host add their
+    changes to `plan` instead of making them. On exit, modules registered with
+    `after_planning` discard the state they simulated for the host.
+    """
+    host = env.host_string
+    if not _run_depth.get(host):
+        start_run(host)
+    _plans[host] = plan
+    try:
+        yield plan
+    finally:
+        del _plans[host]
+        for func in _planning_listeners:
+            func(host)
+
+def after_planning(func):
+    """
+    Registers `func` to be called with the host_string when planning for that
+    host ends. Usable as a decorator.
+    """
+    _planning_listeners.append(func)
+    return func
+
+def before_run(func):
+    """
+    Registers `func` to be called with the host_string when a run or plan on
+    that host starts, eg. to discard what it cached about the host during an
+    earlier one. Usable as a decorator.
+    """
+    _run_listeners.append(func)
+    return func
+
+def start_run(host):
+    for func in _run_listeners:
+        func(host)
+
+def handler(name):
+    """
+    Decorator registering a function as the notification handler `name`.
+    Resources that list it in their `notifies` setting notify it when they
+    change, and it is then called once per host at the end of the run,
+    after every resource has been ensured. Handlers run in the order they
+    were registered.
+    """
+    def register(func):
+        _handlers[:] = [h for h in _handlers if h[0] != name]
+        _handlers.append((name, func))
+        return func
+    return register
+
+def notify(name):
+    """
+    Notifies the handler `name` that something it watches on the current
+    host has changed, for it to be called at the end of the run (see
+    `notifications`). Nothing is recorded while planning, and notifications
+    outside of a run are dropped with a warning.
+    """
+    if name not in [h[0] for h in _handlers]:
+        abort('Unknown handler: {}'.format(name))
+    if simulating():
+        return
+    host = env.host_string
+    if not _run_depth.get(host):
+        warn('Handler {} was notified outside of a run, and will not be '
+                'called'.format(name))
+        return
+    _notified.setdefault(host, set()).add(name)
+
+@contextlib.contextmanager
+def notifications():
+    """
+    Context manager around a run on the current host, which calls the
+    handlers notified during it on exit. Nested runs leave them to the
+    outermost one. If the run fails, they are still called, for the changes
+    made before it did. Modules registered with `before_run` are told when the
+    outermost one starts.
+    """
+    host = env.host_string
+    if not _run_depth.get(host):
+        start_run(host)
+    _run_depth[host] = _run_depth.get(host, 0) + 1
+    try:
+        yield
+    finally:
+        _run_depth[host] -= 1
+        if not _run_depth[host]:
+            notified = _notified.pop(host, ())
+            for name, func in list(_handlers):
+                if name in notified:
+                    with instrument.span(name, 'handler'):
+                        func()
+
+def simulating():
+    """
+    Returns True if changes are currently being planned (or dry run) rather
+    than made.
+    """
+    return env.dry_run or env.host_string in _plans
+
+def schedule(resources, func, workers=1):
+    """
+    Calls `func` on each resource once all of its dependencies (among
+    `resources`) have been handled, keeping the given order where possible.
+    Up to `workers` threadsafe resources are handled concurrently in threads
+    sharing the current host's connection. Others are handled in the calling
+    thread, while no worker is busy.
+    """
+    providers = {}
+    for r in resources:
+        for token in r.provides():
+            providers.setdefault(token, r)
+    waiting = collections.OrderedDict()
+    dependents = collections.defaultdict(list)
+    for r in resources:
+        deps = set()
+        for token in r.dependencies():
+            dep = providers.get(token)
+            if dep is not None and dep is not r:
+                deps.add(dep.key)
+        waiting[r.key] = deps
+        for key in deps:
+            dependents[key].append(r)
+
+    ready = collections.deque(r for r in resources if not waiting[r.key])
+    for r in ready:
+        del waiting[r.key]
+
+    def finished(r):
+        for dependent in dependents[r.key]:
+            deps = waiting[dependent.key]
+            deps.discard(r.key)
+            if not deps:
+                del waiting[dependent.key]
+                ready.append(dependent)
+
+    if workers <= 1:
+        while ready:
+            r = ready.popleft()
+            func(r)
+            finished(r)
+    else:
+        _schedule_threaded(ready, finished, func, workers)
+
+    if waiting:
+        cycle = ', '.join(waiting)
+        abort('Circular resource dependencies between: {}'.format(cycle))
+
+def _schedule_threaded(ready, finished, func, workers):
+    jobs = Queue.Queue()
+    done = Queue.Queue()
+
+    def work():
+        while True:
+            r = jobs.get()
+            if r is None:
+                return
+            try:
+                func(r)
+                done.put((r, None))
+            except BaseException:
+                done.put((r, sys.exc_info()))
+
+    threads = [threading.Thread(target=work) for i in range(workers)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    running = 0
+    error = None
+    try:
+        while ready or running:
+            while ready and error is None:
+                if ready[0].threadsafe:
+                    jobs.put(ready.popleft())
+                    running += 1
+                    continue
+                if running:
+                    # wait for the workers, then handle it on its own
+                    break
+                r = ready.popleft()
+                try:
+                    func(r)
+                except BaseException:
+                    error = sys.exc_info()
+                else:
+                    finished(r)
+            if not running:
+                break
+            r, exc_info = done.get()
+            running -= 1
+            if exc_info is not None:
+                # let running resources finish, but don't start new ones
+                error = error or exc_info
+            elif error is None:
+                finished(r)
+    finally:
+        for t in threads:
+            jobs.put(None)
+    if error is not None:
+        raise error[0], error[1], error[2]
+
+def converge(resources, hosts, pool_size=None, concurrent=True, method='ensure'):
+    """
+    Runs `method` (ensure, remove or clean) of a ResourceCollection against
+    each of `hosts`. With `concurrent`, hosts are converged in Fabric worker
+    processes, at most `pool_size` (default: env.pool_size) at a time.
+    Otherwise, connections to all hosts are set up together beforehand.
+
+    Returns a dict mapping each host to a dict with the number of resources,
+    the elapsed time and whether the host failed. If quilt.instrument is
+    enabled, what worker processes record is merged into this one's.
+    """
+    def converge_host():
+        from quilt import pushy_support
+        if env.parallel:
+            # forked workers must open their own connections
+            _remote_import_cache.clear()
+            pushy_support.reset()
+            instrument.reset()
+        result = {'resources': 0, 'elapsed': 0, 'failed': False}
+        start = time.time()
+        try:
+            getattr(resources, method)()
+        except SystemExit:
+            # abort() has already reported the error for this host
+            result['failed'] = True
+        finally:
+            if env.parallel:
+                pushy_support.close_all()
+        result['resources'] = len(list(resources))
+        result['elapsed'] = time.time() - start
+        if env.parallel and instrument.enabled():
+            # hand what the worker recorded back to the parent process
+            result['instrument'] = instrument.export(env.host_string)
+        return result
+
+    if concurrent:
+        converge_host = parallel(pool_size=pool_size)(converge_host)
+    else:
+        from quilt import pushy_support
+        # hosts that fail here are reported when they are converged
+        pushy_support.warm_up(hosts, pool_size=pool_size)
+    results = execute(converge_host, hosts=hosts)
+    for result in results.values():
+        if isinstance(result, dict) and 'instrument' in result:
+            instrument.merge(result.pop('instrument'))
+    return results
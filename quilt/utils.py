@@ -1,5 +1,15 @@
 import collections
 
+# Bumped whenever any DefaultAttributeDict is changed, see `settings_version`
+_version = 0
+
+def settings_version():
+    """
+    Returns a number that changes whenever a value is set or removed in any
+    DefaultAttributeDict, so that settings derived from them can be cached.
+    """
+    return _version
+
 class DefaultAttributeDict(collections.defaultdict):
     """
     Allows dynamic creation of env values, eg:
@@ -9,6 +19,40 @@ class DefaultAttributeDict(collections.defaultdict):
         factory = DefaultAttributeDict
         super(DefaultAttributeDict, self).__init__(factory, *args, **kwargs)
 
+    def __missing__(self, key):
+        # an empty node changes no settings, so it doesn't bump the version
+        value = DefaultAttributeDict()
+        dict.__setitem__(self, key, value)
+        return value
+
+    def __setitem__(self, key, value):
+        _changed()
+        super(DefaultAttributeDict, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        _changed()
+        super(DefaultAttributeDict, self).__delitem__(key)
+
+    def update(self, *args, **kwargs):
+        _changed()
+        super(DefaultAttributeDict, self).update(*args, **kwargs)
+
+    def setdefault(self, key, default=None):
+        _changed()
+        return super(DefaultAttributeDict, self).setdefault(key, default)
+
+    def pop(self, *args):
+        _changed()
+        return super(DefaultAttributeDict, self).pop(*args)
+
+    def popitem(self):
+        _changed()
+        return super(DefaultAttributeDict, self).popitem()
+
+    def clear(self):
+        _changed()
+        super(DefaultAttributeDict, self).clear()
+
     def __getattr__(self, key):
         try:
             return self[key]
@@ -31,3 +75,7 @@ class DefaultAttributeDict(collections.defaultdict):
     def __unicode__(self):
         return "<DefaultAttributeDict>"
 
+def _changed():
+    global _version
+    _version += 1
+
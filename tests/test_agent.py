@@ -0,0 +1,73 @@
+import os
+import shutil
+import tempfile
+import unittest
+from quilt import agent
+
+class CompareTreeTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.root, 'dir'))
+        os.chmod(os.path.join(self.root, 'dir'), 0755)
+        self.write('dir/a', 'aaa', 100)
+        os.symlink('dir/a', os.path.join(self.root, 'link'))
+        self.sha256 = agent.file_hash(os.path.join(self.root, 'dir/a'))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, rel, content, mtime):
+        path = os.path.join(self.root, rel)
+        with open(path, 'wb') as f:
+            f.write(content)
+        os.chmod(path, 0644)
+        os.utime(path, (mtime, mtime))
+
+    def entries(self, **changes):
+        entries = {
+            'dir': ['directory', 0755],
+            'dir/a': ['file', 0644, 3, 100, self.sha256],
+            'link': ['symlink', 'dir/a'],
+        }
+        entries.update(changes)
+        return entries
+
+    def compare(self, entries, delete=False):
+        return agent.compare_tree(self.root, entries, -1, -1, delete)
+
+    def test_unchanged(self):
+        self.assertEqual(self.compare(self.entries()), [])
+
+    def test_missing(self):
+        entries = self.entries(**{'dir/b': ['file', 0644, 1, 100, 'x']})
+        self.assertEqual(self.compare(entries), [['dir/b', 'missing']])
+
+    def test_content(self):
+        self.write('dir/a', 'abc', 200)
+        self.assertEqual(self.compare(self.entries()), [['dir/a', 'content']])
+        self.write('dir/a', 'abcd', 100)
+        self.assertEqual(self.compare(self.entries()), [['dir/a', 'content']])
+
+    def test_mtime_only(self):
+        os.utime(os.path.join(self.root, 'dir/a'), (200, 200))
+        self.assertEqual(self.compare(self.entries()), [['dir/a', 'mtime']])
+
+    def test_mode(self):
+        os.chmod(os.path.join(self.root, 'dir/a'), 0600)
+        self.assertEqual(self.compare(self.entries()), [['dir/a', 'mode']])
+
+    def test_type_and_symlink_target(self):
+        entries = self.entries(**{'dir': ['file', 0755, 0, 0, ''],
+            'link': ['symlink', 'elsewhere']})
+        self.assertEqual(self.compare(entries),
+                [['dir', 'type'], ['link', 'content']])
+
+    def test_extra(self):
+        os.mkdir(os.path.join(self.root, 'dir/sub'))
+        self.write('dir/sub/x', 'x', 100)
+        self.assertEqual(self.compare(self.entries()), [])
+        self.assertEqual(self.compare(self.entries(), delete=True),
+                [['dir/sub/x', 'extra'], ['dir/sub', 'extra_dir']])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,235 @@
+import errno
+import marshal
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+from fabric.api import env, hide
+from quilt import agent, benchmark, pushy_support, resources
+from quilt.contrib.fs import resources as fs
+from quilt.contrib.fs.resources import Directory, File
+
+
+class FileTest(unittest.TestCase):
+    """
+    Ensures files in a temporary directory, with commands run locally as in
+    the benchmark.
+    """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, 'file')
+        resources._registry.clear()
+        self.loopback = benchmark.loopback()
+        self.loopback.__enter__()
+        self.hide = hide('everything')
+        self.hide.__enter__()
+
+    def tearDown(self):
+        self.hide.__exit__(None, None, None)
+        self.loopback.__exit__(None, None, None)
+        env.resources.fs.manifest = None
+        shutil.rmtree(self.root)
+
+    def file(self, path=None, **kwargs):
+        kwargs.update(benchmark.owner_settings())
+        return File(path or self.path, **kwargs)
+
+    def ensure(self, *items):
+        resources.ResourceCollection(*items).ensure()
+
+    def read(self):
+        with open(self.path) as f:
+            return f.read()
+
+    def test_repairs_content(self):
+        f = self.file(content='one\n')
+        self.ensure(f)
+        self.ensure(f)
+        with open(self.path, 'w') as out:
+            out.write('tampered\n')
+        self.ensure(f)
+        self.assertEqual(self.read(), 'one\n')
+
+    def test_repairs_mode(self):
+        f = self.file(content='one\n', mode=0644)
+        self.ensure(f)
+        os.chmod(self.path, 0600)
+        self.ensure(f)
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0644)
+
+    def test_rerenders_templates(self):
+        with open(os.path.join(self.root, 'file.tpl'), 'w') as tpl:
+            tpl.write('command={{ command }}\n')
+        f = self.file(template='file.tpl', command='/bin/one')
+        f.get_template_path = lambda name: self.root
+        self.ensure(f)
+        f.command = '/bin/two'
+        self.ensure(f)
+        self.assertEqual(self.read(), 'command=/bin/two')
+
+    def test_reads_streams_once(self):
+        f = self.file(content=iter(['one', '\n']))
+        self.ensure(f)
+        os.unlink(self.path)
+        self.ensure(f)
+        self.assertEqual(self.read(), 'one\n')
+
+    def test_planning_skips_unchanged_files(self):
+        env.resources.fs.manifest = os.path.join(self.root, 'manifest.json')
+        source = os.path.join(self.root, 'source')
+        os.mkdir(source)
+        with open(os.path.join(source, 'a'), 'w') as f:
+            f.write('a\n')
+        unchanged = self.file(content='one\n')
+        self.ensure(unchanged)
+        ensured = []
+        unchanged.ensure_path = ensured.append
+        # syncing the directory batches its own operations while planning
+        synced = Directory(os.path.join(self.root, 'synced'), source=source,
+                **benchmark.owner_settings())
+        changes = resources.ResourceCollection(synced, unchanged).plan(1)
+        self.assertEqual(ensured, [])
+        self.assertEqual(sorted(c['op']['path'] for c in changes
+                if c['op']['op'] != 'chown'), [synced.path,
+                    os.path.join(synced.path, 'a')])
+
+    def test_recreates(self):
+        f = self.file(content='one\n')
+        self.ensure(f)
+        os.unlink(self.path)
+        self.ensure(f)
+        self.assertEqual(self.read(), 'one\n')
+
+
+class Agent(object):
+    """
+    Calls the agent's functions locally, through marshal as a remote agent
+    does, and records the operations applied. Operations on `refused` paths
+    fail as if the session were not permitted to perform them, and `uid`
+    stands in for the uid it runs as.
+    """
+
+    def __init__(self, refused=(), uid=None):
+        self.refused = refused
+        self.uid = uid
+        self.applied = []
+
+    def __getattr__(self, name):
+        def call(*args):
+            args = marshal.loads(marshal.dumps(args))
+            return marshal.loads(marshal.dumps(getattr(agent, name)(*args)))
+        return call
+
+    def gather_facts(self, paths, with_identities=False):
+        result = self.__getattr__('gather_facts')(paths, with_identities)
+        if self.uid is not None:
+            result['uid'] = self.uid
+        return result
+
+    def apply(self, operations, archive=None, staged_archive=None):
+        self.applied.append(([op['path'] for op in operations], archive))
+        funcs = dict((name, func) for name, func in vars(agent).items()
+                if name.startswith('op_'))
+        def refusing(func):
+            def op(path, **kwargs):
+                if path in self.refused:
+                    raise OSError(errno.EPERM, 'Operation not permitted', path)
+                return func(path, **kwargs)
+            return op
+        for name, func in funcs.iteritems():
+            setattr(agent, name, refusing(func))
+        try:
+            return self.__getattr__('apply')(operations, archive, staged_archive)
+        finally:
+            for name, func in funcs.iteritems():
+                setattr(agent, name, func)
+
+class FlushTest(unittest.TestCase):
+    """
+    Applies batches through stand-ins for the remote and privileged agents.
+    """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        resources._registry.clear()
+        env.host_string = 'test'
+        self.saved = pushy_support.remote_agent, pushy_support.privileged_agent
+        self.agent = Agent()
+        self.privileged = Agent()
+        pushy_support.remote_agent = lambda: self.agent
+        pushy_support.privileged_agent = lambda: self.privileged
+        self.hide = hide('everything')
+        self.hide.__enter__()
+
+    def tearDown(self):
+        self.hide.__exit__(None, None, None)
+        pushy_support.remote_agent, pushy_support.privileged_agent = self.saved
+        fs.forget_host('test')
+        fs._remote_uids.pop('test', None)
+        shutil.rmtree(self.root)
+
+    def files(self, *names, **kwargs):
+        settings = benchmark.owner_settings()
+        settings.update(kwargs)
+        return [File(os.path.join(self.root, name), content=name, **settings)
+                for name in names]
+
+    def test_refused_operations_are_applied_privileged(self):
+        files = self.files('a', 'b', 'c')
+        self.agent.refused = [files[1].path]
+        resources.ResourceCollection(*files).ensure()
+        for f in files:
+            with open(f.path) as content:
+                self.assertEqual(content.read(), os.path.basename(f.path))
+        self.assertEqual([paths for paths, archive in self.agent.applied],
+                [[f.path for f in files]])
+        # the rest of the batch is applied in one call, without its content
+        self.assertEqual(self.privileged.applied,
+                [([files[1].path, files[2].path], None)])
+
+    def test_operations_for_other_users_are_applied_privileged(self):
+        self.agent.uid = 1000
+        files = self.files('a', 'b', 'c', owner='root', group='root')
+        resources.ResourceCollection(*files).ensure()
+        self.assertEqual(self.agent.applied, [])
+        self.assertEqual([paths for paths, archive in self.privileged.applied],
+                [[f.path for f in files]])
+
+class SimulateTest(unittest.TestCase):
+    """
+    Simulates operations as a remote user other than root.
+    """
+
+    def setUp(self):
+        env.host_string = 'test'
+        fs._remote_uids['test'] = 1000
+
+    def tearDown(self):
+        fs.forget_facts('test')
+        fs._remote_uids.pop('test')
+
+    def simulate(self, op, **kwargs):
+        fs.simulate(dict(kwargs, op=op, path='/a'))
+        return fs._facts[('test', '/a')]
+
+    def test_created_paths_belong_to_the_remote_user(self):
+        facts = self.simulate('mkdir', mode=0700)
+        self.assertEqual(facts['uid'], 1000)
+        self.assertTrue(facts['writable'])
+        self.assertTrue(facts['readable'])
+
+    def test_paths_chowned_to_others_are_not_writable(self):
+        self.simulate('mkdir', mode=0755)
+        facts = self.simulate('chown', uid=0, gid=0)
+        self.assertFalse(facts['writable'])
+        self.assertTrue(facts['readable'])
+
+    def test_files_written_for_others(self):
+        facts = self.simulate('write', content='a', mode=0600, uid=0, gid=0)
+        self.assertFalse(facts['writable'])
+        self.assertFalse(facts['readable'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+from distutils.spawn import find_executable
+from fabric.api import env, hide
+from quilt import benchmark, resources
+from quilt.contrib.git.resources import Clone
+
+IDENTITY = {
+    'GIT_AUTHOR_NAME': 'test', 'GIT_AUTHOR_EMAIL': 'test@example.com',
+    'GIT_COMMITTER_NAME': 'test', 'GIT_COMMITTER_EMAIL': 'test@example.com',
+}
+
+def git(*args, **kwargs):
+    output = subprocess.check_output(('git',) + args,
+            env=dict(os.environ, **IDENTITY), **kwargs)
+    return output.strip()
+
+@unittest.skipUnless(find_executable('git'), 'git is not installed')
+class CloneTest(unittest.TestCase):
+    """
+    Clones local bare repositories, with commands run locally as in the
+    benchmark.
+    """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.work = os.path.join(self.root, 'work')
+        self.repo = os.path.join(self.root, 'repo.git')
+        git('init', '-q', self.work)
+        self.commit('one')
+        git('tag', '-a', 'v1', '-m', 'v1', cwd=self.work)
+        self.commit('two')
+        git('branch', '-M', 'main', cwd=self.work)
+        git('clone', '-q', '--bare', self.work, self.repo)
+        resources._registry.clear()
+        self.loopback = benchmark.loopback()
+        self.loopback.__enter__()
+        self.hide = hide('everything')
+        self.hide.__enter__()
+
+    def tearDown(self):
+        self.hide.__exit__(None, None, None)
+        self.loopback.__exit__(None, None, None)
+        shutil.rmtree(self.root)
+
+    def commit(self, message):
+        with open(os.path.join(self.work, 'file'), 'w') as f:
+            f.write(message)
+        git('add', 'file', cwd=self.work)
+        git('commit', '-q', '-m', message, cwd=self.work)
+        return git('rev-parse', 'HEAD', cwd=self.work)
+
+    def push(self):
+        git('push', '-q', self.repo, 'main', cwd=self.work)
+
+    def clone(self, **kwargs):
+        kwargs.update(benchmark.owner_settings())
+        return Clone(os.path.join(self.root, 'clone'), repo=self.repo, **kwargs)
+
+    def ensure(self, clone):
+        resources.ResourceCollection(clone).ensure()
+
+    def plan(self, clone):
+        return list(resources.ResourceCollection(clone).plan())
+
+    def head(self, clone):
+        return git('rev-parse', 'HEAD', cwd=clone.path)
+
+    def test_branch(self):
+        clone = self.clone(revision='main')
+        self.ensure(clone)
+        self.assertEqual(self.head(clone), git('rev-parse', 'main', cwd=self.work))
+        self.assertEqual(self.plan(clone), [])
+
+        commit = self.commit('three')
+        self.push()
+        self.assertEqual([c['action'] for c in self.plan(clone)], ['update'])
+        self.ensure(clone)
+        self.assertEqual(self.head(clone), commit)
+
+    def test_annotated_tag(self):
+        clone = self.clone(revision='v1')
+        self.ensure(clone)
+        self.assertEqual(self.head(clone),
+                git('rev-parse', 'v1^{}', cwd=self.work))
+        self.assertEqual(self.plan(clone), [])
+
+    def test_commit(self):
+        commit = git('rev-parse', 'v1^{}', cwd=self.work)
+        clone = self.clone(revision=commit)
+        self.ensure(clone)
+        self.assertEqual(self.head(clone), commit)
+        self.assertEqual(self.plan(clone), [])
+
+    def test_without_revision(self):
+        clone = self.clone()
+        self.ensure(clone)
+        self.commit('three')
+        self.push()
+        self.assertEqual(self.plan(clone), [])
+
+    def test_reference(self):
+        reference = os.path.join(self.root, 'mirrors')
+        clone = self.clone(revision='main', reference=reference)
+        self.ensure(clone)
+        mirror = clone.reference_path()
+        with open(os.path.join(clone.path, '.git/objects/info/alternates')) as f:
+            self.assertEqual(f.read().strip(), os.path.join(mirror, 'objects'))
+        self.assertEqual(git('--git-dir', mirror, 'config', 'gc.auto'), '0')
+
+        # a branch deleted upstream stays in the mirror
+        git('push', '-q', self.repo, 'main:old', cwd=self.work)
+        commit = self.commit('three')
+        self.push()
+        self.ensure(clone)
+        git('push', '-q', self.repo, ':old', cwd=self.work)
+        self.commit('four')
+        self.push()
+        self.ensure(clone)
+        git('--git-dir', mirror, 'rev-parse', 'old')
+        git('fsck', cwd=clone.path)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import os
+import tempfile
+import unittest
+from fabric.api import env, hide
+from quilt import benchmark, resources
+from quilt.contrib.postgresql import resources as pg
+
+CATALOG = '\n'.join([
+    'd|db|bob||',
+    'r|bob|0|0|0',
+    'a|DATABASE db|bob|CONNECT|0',
+    'a|TABLE public.foo|bob|SELECT|0',
+    'a|TABLE public.foo|bob|INSERT|1',
+    'a|SCHEMA app|bob|USAGE|0',
+    'a|SEQUENCE app.s|bob|USAGE|0',
+    'a|SEQUENCE app.s|bob|SELECT|0',
+    'a|SEQUENCE app.s|bob|UPDATE|0',
+])
+
+class ParseCatalogTest(unittest.TestCase):
+    def test_parse(self):
+        catalog = pg.parse_catalog(CATALOG + '\nr|postgres|1|1|1\n')
+        self.assertEqual(catalog['databases'], {'db': 'bob'})
+        self.assertEqual(catalog['roles'], {
+            'bob': {'superuser': False, 'createdb': False, 'createrole': False},
+            'postgres': {'superuser': True, 'createdb': True,
+                'createrole': True},
+        })
+        self.assertEqual(catalog['acls']['TABLE public.foo'],
+                {'bob': {'SELECT': False, 'INSERT': True}})
+        self.assertEqual(sorted(catalog['acls']), ['DATABASE db',
+            'SCHEMA app', 'SEQUENCE app.s', 'TABLE public.foo'])
+
+    def test_ignores_other_lines(self):
+        catalog = pg.parse_catalog('\n(3 rows)\nd|db|bob\n  d|x|bob||  \n')
+        self.assertEqual(catalog['databases'], {'x': 'bob'})
+
+    def test_public_grants(self):
+        catalog = pg.parse_catalog('a|DATABASE db|PUBLIC|CONNECT|0')
+        self.assertEqual(catalog['acls'], {'DATABASE db': {'PUBLIC':
+            {'CONNECT': False}}})
+
+    def test_catalog_sql_quoting(self):
+        # the query is passed to psql in double quotes
+        self.assertNotIn('"', pg.CATALOG_SQL)
+        self.assertNotIn('$', pg.CATALOG_SQL)
+
+class PrivilegeTest(unittest.TestCase):
+    """
+    Plans privileges against a catalog read by a stand-in for psql.
+    """
+
+    def setUp(self):
+        resources._registry.clear()
+        fd, self.catalog = tempfile.mkstemp()
+        os.close(fd)
+        self.write_catalog(CATALOG)
+        env.resources.postgresql.psql = 'cat {} #'.format(self.catalog)
+        self.loopback = benchmark.loopback()
+        self.loopback.__enter__()
+        self.hide = hide('everything')
+        self.hide.__enter__()
+
+    def tearDown(self):
+        self.hide.__exit__(None, None, None)
+        self.loopback.__exit__(None, None, None)
+        env.resources.postgresql.psql = 'psql'
+        os.unlink(self.catalog)
+
+    def write_catalog(self, output):
+        with open(self.catalog, 'w') as f:
+            f.write(output)
+
+    def plan(self, *items):
+        return list(resources.ResourceCollection(*items).plan())
+
+    def test_acl_object(self):
+        def acl_object(object):
+            resources._registry.clear()
+            return pg.Privilege('SELECT', object=object).get_acl_object()
+        self.assertEqual(acl_object('TABLE Foo'), 'TABLE public.foo')
+        self.assertEqual(acl_object('TABLE "Foo"'), 'TABLE public.Foo')
+        self.assertEqual(acl_object('sequence app.s'), 'SEQUENCE app.s')
+        self.assertEqual(acl_object('DATABASE db'), 'DATABASE db')
+        self.assertEqual(acl_object('FUNCTION f()'), None)
+        self.assertEqual(acl_object('ALL TABLES IN SCHEMA app'), None)
+
+    def test_granted_privileges_are_skipped(self):
+        changes = self.plan(
+            pg.Privilege('SELECT', user='bob', object='TABLE foo'),
+            pg.Privilege('USAGE', user='bob', object='SCHEMA app'),
+            pg.Privilege('ALL', user='bob', object='SEQUENCE app.s'),
+            pg.Privilege('CONNECT', user='bob', object='DATABASE db'))
+        self.assertEqual(changes, [])
+
+    def test_missing_privileges_are_granted(self):
+        changes = self.plan(
+            pg.Privilege('SELECT, UPDATE', user='bob', object='TABLE foo'))
+        self.assertEqual([(c['verb'], c['privileges']) for c in changes],
+                [('GRANT', 'UPDATE')])
+
+    def test_grant_option_is_revoked(self):
+        changes = self.plan(
+            pg.Privilege('INSERT', user='bob', object='TABLE foo'))
+        self.assertEqual([(c['verb'], c['privileges']) for c in changes],
+                [('REVOKE GRANT OPTION FOR', 'INSERT')])
+
+    def test_other_objects_are_reset(self):
+        changes = self.plan(
+            pg.Privilege('EXECUTE', user='bob', object='FUNCTION f()'))
+        self.assertEqual([c['verb'] for c in changes], ['REVOKE', 'GRANT'])
+
+    def test_catalog_is_reloaded_for_each_run(self):
+        privilege = pg.Privilege('CONNECT', user='bob', object='DATABASE db')
+        resources.ResourceCollection(privilege).ensure()
+        self.write_catalog(CATALOG.replace('a|DATABASE db|bob|CONNECT|0\n', ''))
+        self.assertEqual([c['verb'] for c in self.plan(privilege)], ['GRANT'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import os
+import tempfile
+import unittest
+from fabric.api import env, hide
+from quilt import benchmark, resources
+from quilt.contrib.rabbitmq import resources as rabbitmq
+
+class ParseSnapshotTest(unittest.TestCase):
+    def test_parse(self):
+        output = '\r\n'.join([
+            'user\tguest',
+            'user\tapp',
+            'vhost\t/',
+            'vhost\t/app',
+            'permission\tapp\t/app\t.*\t^app\\.\t',
+            'password\tapp\tok',
+            'password\tguest\trefused',
+            'ok',
+        ])
+        snapshot = rabbitmq.parse_snapshot(output)
+        self.assertEqual(snapshot['users'], set(['guest', 'app']))
+        self.assertEqual(snapshot['vhosts'], set(['/', '/app']))
+        self.assertEqual(snapshot['permissions'],
+                {('app', '/app'): ('.*', '^app\\.', '')})
+        self.assertEqual(snapshot['passwords'], {'app': True, 'guest': False})
+
+    def test_ignores_other_lines(self):
+        snapshot = rabbitmq.parse_snapshot(
+                'Evaluating...\nuser\nvhost\ta\tb\npermission\tx\n')
+        self.assertEqual(snapshot, {'users': set(), 'vhosts': set(),
+            'permissions': {}, 'passwords': {}})
+
+class PasswordChecksTest(unittest.TestCase):
+    def test_none(self):
+        self.assertEqual(rabbitmq.password_checks([]), '')
+
+    def test_quoting(self):
+        expression = rabbitmq.password_checks([('app', 'p"w\\d')])
+        self.assertIn('{"app", "p\\"w\\\\d"}', expression)
+
+    def test_snapshot_expression(self):
+        expression = rabbitmq.SNAPSHOT_ERL.format(
+                rabbitmq.password_checks([('app', 'pw')]))
+        self.assertTrue(expression.endswith('ok.'))
+        self.assertIn('check_user_pass_login', expression)
+
+class VhostTest(unittest.TestCase):
+    """
+    Plans vhosts against a snapshot printed by a stand-in for rabbitmqctl.
+    """
+
+    def setUp(self):
+        resources._registry.clear()
+        fd, self.snapshot = tempfile.mkstemp()
+        os.close(fd)
+        self.write_snapshot('vhost\t/\nvhost\t/app\n')
+        env.resources.rabbitmq.rabbitmqctl = 'cat {} #'.format(self.snapshot)
+        self.loopback = benchmark.loopback()
+        self.loopback.__enter__()
+        self.hide = hide('everything')
+        self.hide.__enter__()
+
+    def tearDown(self):
+        self.hide.__exit__(None, None, None)
+        self.loopback.__exit__(None, None, None)
+        env.resources.rabbitmq.rabbitmqctl = 'rabbitmqctl'
+        os.unlink(self.snapshot)
+
+    def write_snapshot(self, output):
+        with open(self.snapshot, 'w') as f:
+            f.write(output)
+
+    def test_snapshot_is_retaken_for_each_run(self):
+        vhost = rabbitmq.Vhost('/app')
+        resources.ResourceCollection(vhost).ensure()
+        self.write_snapshot('vhost\t/\n')
+        changes = list(resources.ResourceCollection(vhost).plan())
+        self.assertEqual([c['command'] for c in changes],
+                ['cat {} # add_vhost /app'.format(self.snapshot)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+import threading
+import time
+import unittest
+from fabric.api import env, hide
+from quilt import resources
+from quilt.contrib.fs import resources as fs
+
+class PlanTest(unittest.TestCase):
+    def setUp(self):
+        resources._registry.clear()
+
+    def test_round_trip(self):
+        content = '\x00\xff\xfe binary'
+        plan = resources.Plan('host', [
+            {'resource': 'fs.file[/a]', 'action': 'fs', 'op': {'op': 'write',
+                'path': '/a', 'content': content, 'mode': 0644}},
+            {'resource': 'fs.file[/b]', 'action': 'run', 'command': 'true'},
+        ])
+        loaded = resources.Plan.loads(plan.dumps())
+        self.assertEqual(loaded.host_string, 'host')
+        self.assertEqual(loaded.changes, plan.changes)
+        self.assertEqual(loaded.changes[0]['op']['content'], content)
+
+    def test_spooled_content_is_inlined(self):
+        threshold = fs.STREAM_THRESHOLD
+        fs.STREAM_THRESHOLD = 4
+        try:
+            kind, path = fs.spool(['\xff' * 3, 'abc'])
+        finally:
+            fs.STREAM_THRESHOLD = threshold
+        self.assertEqual(kind, 'source')
+        plan = resources.Plan('host')
+        plan.add(fs.File('/a'), {'action': 'fs', 'op': {'op': 'write',
+            'path': '/a', 'source': path, 'mode': 0644}})
+        op = resources.Plan.loads(plan.dumps()).changes[0]['op']
+        self.assertEqual(op['content'], '\xff\xff\xffabc')
+        self.assertNotIn('source', op)
+
+class Item(object):
+    def __init__(self, key, requires=(), threadsafe=True):
+        self.key = key
+        self.requires = requires
+        self.threadsafe = threadsafe
+
+    def provides(self):
+        return [self.key]
+
+    def dependencies(self):
+        return list(self.requires)
+
+class ScheduleTest(unittest.TestCase):
+    def test_dependencies_first(self):
+        order = []
+        items = [Item('c', ['b']), Item('b', ['a']), Item('a'), Item('d')]
+        resources.schedule(items, lambda r: order.append(r.key))
+        self.assertEqual(order, ['a', 'd', 'b', 'c'])
+
+    def test_unknown_dependencies_are_ignored(self):
+        order = []
+        resources.schedule([Item('a', ['x'])], lambda r: order.append(r.key))
+        self.assertEqual(order, ['a'])
+
+    def test_cycle(self):
+        items = [Item('a', ['b']), Item('b', ['a']), Item('c')]
+        with hide('aborts'):
+            self.assertRaises(SystemExit, resources.schedule, items,
+                    lambda r: None)
+
+    def test_threaded(self):
+        lock = threading.Lock()
+        state = {'running': 0, 'most': 0, 'alone': True}
+        order = []
+        def func(r):
+            with lock:
+                state['running'] += 1
+                state['most'] = max(state['most'], state['running'])
+                if not r.threadsafe and state['running'] > 1:
+                    state['alone'] = False
+                order.append(r.key)
+            time.sleep(0.01)
+            with lock:
+                state['running'] -= 1
+        items = [Item('a'), Item('b'), Item('c', threadsafe=False),
+                Item('d', ['a']), Item('e')]
+        resources.schedule(items, func, 4)
+        self.assertEqual(sorted(order), ['a', 'b', 'c', 'd', 'e'])
+        self.assertTrue(order.index('d') > order.index('a'))
+        self.assertTrue(state['alone'])
+        self.assertTrue(state['most'] > 1)
+
+    def test_threaded_error(self):
+        def func(r):
+            if r.key == 'a':
+                raise ValueError
+        items = [Item('a'), Item('b', ['a'])]
+        self.assertRaises(ValueError, resources.schedule, items, func, 2)
+
+class NotificationsTest(unittest.TestCase):
+    def setUp(self):
+        env.host_string = 'test'
+        self.calls = []
+        resources.handler('test')(lambda: self.calls.append('test'))
+
+    def tearDown(self):
+        resources._handlers[:] = [h for h in resources._handlers
+                if h[0] != 'test']
+
+    def test_called_once_at_the_end(self):
+        with resources.notifications():
+            with resources.notifications():
+                resources.notify('test')
+            resources.notify('test')
+            self.assertEqual(self.calls, [])
+        self.assertEqual(self.calls, ['test'])
+
+    def test_called_when_the_run_fails(self):
+        def fail():
+            with resources.notifications():
+                resources.notify('test')
+                raise ValueError
+        self.assertRaises(ValueError, fail)
+        self.assertEqual(self.calls, ['test'])
+
+    def test_dropped_outside_a_run(self):
+        with hide('warnings'):
+            resources.notify('test')
+        with resources.notifications():
+            pass
+        self.assertEqual(self.calls, [])
+
+if __name__ == '__main__':
+    unittest.main()